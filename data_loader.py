@@ -20,6 +20,10 @@ def get_loader(mode_data,
                shuffling=False,
                num_workers=0,
                HOROVOD=False,
+               shards='',
+               resize_cache='',
+               gpu_augment=False,
+               seed=0,
                **kwargs):
 
     mean = (0.5, 0.5, 0.5)
@@ -56,9 +60,31 @@ def get_loader(mode_data,
         transform += [transforms.RandomHorizontalFlip()]
     transform += [transforms.ToTensor(), transforms.Normalize(mean, std)]
 
+    augment = None
+    if gpu_augment and mode == 'train':
+        # Workers only decode and resize, the rest runs batched on the device
+        from misc.augment import BatchAugment, ToByteTensor
+        augment = BatchAugment(
+            image_size,
+            crop=mode_data != 'faces',
+            flip=dataset != 'RafD',
+            mean=mean,
+            std=std)
+        transform = [transform[0], ToByteTensor()]
+
+    cached = resize_cache and not shards
+    if cached:
+        # Deterministic Resize is computed once and cached on disk
+        resize = transform.pop(0)
     transform = transforms.Compose(transform)
-    dataset_module = getattr(
-        importlib.import_module('datasets.{}'.format(dataset)), dataset)
+    if shards:
+        # Packed split, see misc/shards.py
+        from misc.shards import ShardDataset
+        dataset_module = ShardDataset
+        mode_data = shards
+    else:
+        dataset_module = getattr(
+            importlib.import_module('datasets.{}'.format(dataset)), dataset)
     dataset = dataset_module(
         image_size,
         mode_data,
@@ -67,23 +93,29 @@ def get_loader(mode_data,
         shuffling=shuffling or mode == 'train',
         verbose=mode == 'train' and hvd.rank() == 0,
         **kwargs)
-    if hvd.size() == 1:
-        data_loader = DataLoader(
-            dataset=dataset,
-            batch_size=batch_size,
-            shuffle=False,
-            num_workers=num_workers)
+    if cached:
+        from misc.image_cache import CachedDataset
+        dataset = CachedDataset(dataset, resize, resize_cache)
+    if mode == 'train':
+        # Per-epoch permutation of indices, split across ranks
+        from misc.sampler import EpochSampler
+        sampler = EpochSampler(
+            len(dataset), num_replicas=hvd.size(), rank=hvd.rank(), seed=seed)
+    elif HOROVOD and hvd.size() != 1:
+        # Evaluation split across ranks
+        from misc.sampler import ShardSampler
+        sampler = ShardSampler(
+            len(dataset), num_replicas=hvd.size(), rank=hvd.rank())
     elif hvd.size() != 1:
-        if mode == 'train':
-            sampler = torch.utils.data.distributed.DistributedSampler(
-                dataset, num_replicas=hvd.size(), rank=hvd.rank())
-        else:
-            sampler = torch.utils.data.distributed.DistributedSampler(
-                dataset, num_replicas=1, rank=0)
-        data_loader = DataLoader(
-            dataset=dataset,
-            batch_size=batch_size,
-            shuffle=False,
-            num_workers=num_workers,
-            sampler=sampler)
+        sampler = torch.utils.data.distributed.DistributedSampler(
+            dataset, num_replicas=1, rank=0)
+    else:
+        sampler = None
+    data_loader = DataLoader(
+        dataset=dataset,
+        batch_size=batch_size,
+        shuffle=False,
+        num_workers=num_workers,
+        sampler=sampler)
+    data_loader.augment = augment
     return data_loader
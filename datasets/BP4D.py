@@ -3,6 +3,8 @@ import os
 import random
 from torch.utils.data import Dataset
 from PIL import Image
+import numpy as np
+from misc.metadata import compiled_index
 
 # ==================================================================#
 # == BP4D
@@ -29,7 +31,7 @@ class BP4D(Dataset):
             os.path.join('data', 'BP4D', mode_data, 'fold_0', mode + '.txt'))
         if self.verbose:
             print("Data from: " + file_txt)
-        self.lines = open(file_txt, 'r').readlines()
+        self.file_txt = file_txt
         if self.verbose:
             print('Start preprocessing %s: %s!' % (self.name, mode))
         random.seed(1234)
@@ -40,9 +42,19 @@ class BP4D(Dataset):
                                                            self.num_data))
 
     def preprocess(self):
-        self.filenames = []
-        self.labels = []
-        lines = [i.strip() for i in self.lines]
+        self.filenames, self.labels = compiled_index(
+            self.index_file(), [self.file_txt],
+            self.build_index,
+            verbose=self.verbose)
+
+    def index_file(self):
+        mode_size = 'Sequences_400' if self.image_size == 256 else 'Sequences'
+        return self.file_txt.replace('.txt', '_{}_index.npz'.format(mode_size))
+
+    def build_index(self):
+        filenames = []
+        labels = []
+        lines = [i.strip() for i in open(self.file_txt, 'r').readlines()]
         random.shuffle(lines)
         mode_size = 'Sequences_400' if self.image_size == 256 else 'Sequences'
         for i, line in enumerate(lines):
@@ -56,8 +68,9 @@ class BP4D(Dataset):
             label = []
             for value in values:
                 label.append(int(value))
-            self.filenames.append(filename)
-            self.labels.append(label)
+            filenames.append(filename)
+            labels.append(label)
+        return filenames, labels
 
     def get_data(self):
         return self.filenames, self.labels
@@ -72,7 +85,6 @@ class BP4D(Dataset):
         return self.num_data
 
     def shuffle(self, seed):
-        random.seed(seed)
-        random.shuffle(self.filenames)
-        random.seed(seed)
-        random.shuffle(self.labels)
+        order = np.random.RandomState(seed).permutation(self.num_data)
+        self.filenames = self.filenames[order]
+        self.labels = self.labels[order]
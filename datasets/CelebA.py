@@ -5,6 +5,7 @@ from torch.utils.data import Dataset
 from PIL import Image
 import numpy as np
 from misc.utils import PRINT
+from misc.metadata import compiled_index
 
 # ==================================================================#
 # == CelebA
@@ -29,17 +30,8 @@ class CelebA(Dataset):
         self.all_attr = all_attr
         self.mode_data = mode_data
         self.verbose = verbose
-        self.lines = [
-            line.strip().split(',') for line in open(
-                os.path.abspath('data/CelebA/list_attr_celeba.txt')).
-            readlines()
-        ]
-        self.splits = {
-            line.split(',')[0]: int(line.strip().split(',')[1])
-            for line in open(
-                os.path.abspath('data/CelebA/train_val_test.txt')).readlines()
-            [1:]
-        }
+        self.attr_file = os.path.abspath('data/CelebA/list_attr_celeba.txt')
+        self.split_file = os.path.abspath('data/CelebA/train_val_test.txt')
         self.mode_allowed = [0, 1] if mode == 'train' else [2]
         self.all_attr2idx = {}
         self.all_idx2attr = {}
@@ -54,7 +46,26 @@ class CelebA(Dataset):
             print('Finished preprocessing %s: %s (%d)!' % (self.name, mode,
                                                            self.num_data))
 
+    def read_lines(self):
+        self.lines = [
+            line.strip().split(',')
+            for line in open(self.attr_file).readlines()
+        ]
+        self.splits = {
+            line.split(',')[0]: int(line.strip().split(',')[1])
+            for line in open(self.split_file).readlines()[1:]
+        }
+
     def histogram(self):
+        histogram_file = 'datasets/{}_histogram_attributes.txt'.format(
+            self.name)
+        if os.path.isfile(histogram_file) and os.stat(
+                histogram_file).st_mtime >= os.stat(self.attr_file).st_mtime:
+            # Up to date with the attribute file, no need to parse it
+            print(open(histogram_file).read().rstrip('\n'))
+            return
+        if not hasattr(self, 'lines'):
+            self.read_lines()
         values = np.array([int(i) for i in self.lines[1][1:]]) * 0
         for line in self.lines[1:]:
             value = np.array([int(i) for i in line[1:]]).clip(min=0)
@@ -63,8 +74,7 @@ class CelebA(Dataset):
         for key, value in zip(self.lines[0][1:], values):
             dict_[key] = value
         total = 0
-        with open('datasets/{}_histogram_attributes.txt'.format(self.name),
-                  'w') as f:
+        with open(histogram_file, 'w') as f:
             for key, value in sorted(
                     dict_.items(), key=lambda kv: (kv[1], kv[0]),
                     reverse=True):
@@ -73,7 +83,9 @@ class CelebA(Dataset):
             PRINT(f, 'TOTAL {}'.format(total))
 
     def preprocess(self):
-        attrs = self.lines[0][1:]
+        # Attribute names from the header only, the index may be cached
+        with open(self.attr_file) as f:
+            attrs = f.readline().strip().split(',')[1:]
         if self.verbose:
             self.histogram()
 
@@ -106,8 +118,20 @@ class CelebA(Dataset):
         for i, attr in enumerate(self.selected_attrs):
             self.attr2idx[attr] = i
             self.idx2attr[i] = attr
-        self.filenames = []
-        self.labels = []
+
+        index_file = os.path.abspath('data/CelebA/index_{}_{}.npz'.format(
+            'train' if self.mode == 'train' else 'test', self.all_attr))
+        self.filenames, self.labels = compiled_index(
+            index_file, [self.attr_file, self.split_file],
+            self.build_index,
+            verbose=self.verbose)
+        self.num_data = len(self.filenames)
+
+    def build_index(self):
+        if not hasattr(self, 'lines'):
+            self.read_lines()
+        filenames = []
+        labels = []
 
         lines = self.lines[1:]
         # if self.shuffling: random.shuffle(lines)
@@ -129,10 +153,10 @@ class CelebA(Dataset):
                 else:
                     label.append(0)
 
-            self.filenames.append(filename)
-            self.labels.append(label)
+            filenames.append(filename)
+            labels.append(label)
 
-        self.num_data = len(self.filenames)
+        return filenames, labels
 
     def get_data(self):
         return self.filenames, self.labels
@@ -147,7 +171,6 @@ class CelebA(Dataset):
         return self.num_data
 
     def shuffle(self, seed):
-        random.seed(seed)
-        random.shuffle(self.filenames)
-        random.seed(seed)
-        random.shuffle(self.labels)
+        order = np.random.RandomState(seed).permutation(self.num_data)
+        self.filenames = self.filenames[order]
+        self.labels = self.labels[order]
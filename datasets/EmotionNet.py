@@ -3,6 +3,8 @@ import os
 import random
 from torch.utils.data import Dataset
 from PIL import Image
+import numpy as np
+from misc.metadata import compiled_index
 
 # ==================================================================#
 # == EmotionNet
@@ -34,7 +36,7 @@ class EmotionNet(Dataset):
             os.path.join('data', 'EmotionNet', mode_data, mode + '.txt'))
         if self.verbose:
             print("Data from: " + file_txt)
-        self.lines = open(file_txt, 'r').readlines()
+        self.file_txt = file_txt
 
         if self.verbose:
             print('Start preprocessing %s: %s!' % (self.name, mode))
@@ -47,9 +49,21 @@ class EmotionNet(Dataset):
                                                            self.num_data))
 
     def preprocess(self):
-        self.filenames = []
-        self.labels = []
-        lines = [i.strip() for i in self.lines]
+        self.filenames, self.labels = compiled_index(
+            self.index_file(), [self.file_txt],
+            self.build_index,
+            verbose=self.verbose)
+
+    def index_file(self):
+        # Image folder and shuffling change the compiled list
+        shuffled = self.mode == 'train' or self.shuffling
+        return self.file_txt.replace('.txt', '_{}_{}_index.npz'.format(
+            os.path.basename(os.path.dirname(self.ssd)), int(shuffled)))
+
+    def build_index(self):
+        filenames = []
+        labels = []
+        lines = [i.strip() for i in open(self.file_txt, 'r').readlines()]
         if self.mode == 'train' or self.shuffling:
             random.shuffle(lines)  # random shuffling
         for i, line in enumerate(lines):
@@ -64,8 +78,9 @@ class EmotionNet(Dataset):
             for value in values:
                 label.append(int(value))
 
-            self.filenames.append(filename)
-            self.labels.append(label)
+            filenames.append(filename)
+            labels.append(label)
+        return filenames, labels
 
     def get_data(self):
         return self.filenames, self.labels
@@ -80,7 +95,6 @@ class EmotionNet(Dataset):
         return self.num_data
 
     def shuffle(self, seed):
-        random.seed(seed)
-        random.shuffle(self.filenames)
-        random.seed(seed)
-        random.shuffle(self.labels)
+        order = np.random.RandomState(seed).permutation(self.num_data)
+        self.filenames = self.filenames[order]
+        self.labels = self.labels[order]
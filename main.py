@@ -35,7 +35,11 @@ def main(config):
         config.mode,
         num_workers=config.num_workers,
         all_attr=config.ALL_ATTR,
-        c_dim=config.c_dim)
+        c_dim=config.c_dim,
+        shards=config.shards,
+        resize_cache=config.resize_cache,
+        gpu_augment=config.gpu_augment,
+        seed=config.seed)
 
     from misc.scores import set_score
     if set_score(config):
@@ -0,0 +1,93 @@
+"""Batched augmentation on the training device.
+
+With --gpu_augment the loader workers only decode and resize, and yield
+uint8 batches. BatchAugment then applies the RandomResizedCrop,
+RandomHorizontalFlip and Normalize of get_loader to the whole batch as
+tensor ops, with its own generator seeded per call (count_seed in Train).
+"""
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+
+# ==================================================================#
+# ==================================================================#
+class ToByteTensor(object):
+    """PIL image to uint8 tensor (C, H, W) without rescaling"""
+
+    def __call__(self, image):
+        image = torch.from_numpy(np.array(image, dtype=np.uint8))
+        return image.permute(2, 0, 1).contiguous()
+
+
+# ==================================================================#
+# ==================================================================#
+class BatchAugment(object):
+    # Seeds are shifted so the crops do not share the stream used by
+    # random_style with the same count_seed
+    SEED_OFFSET = 1 << 30
+
+    def __init__(self,
+                 image_size,
+                 crop=True,
+                 flip=True,
+                 scale=(0.7, 1.0),
+                 ratio=(0.8, 1.2),
+                 mean=(0.5, 0.5, 0.5),
+                 std=(0.5, 0.5, 0.5)):
+        self.image_size = image_size
+        self.crop = crop
+        self.flip = flip
+        self.scale = scale
+        self.log_ratio = (math.log(ratio[0]), math.log(ratio[1]))
+        self.mean = mean
+        self.std = std
+        self.generator = torch.Generator()
+
+    def uniform(self, n, low, high):
+        return torch.rand(n, generator=self.generator) * (high - low) + low
+
+    def get_theta(self, n, height, width):
+        # Same distribution as transforms.RandomResizedCrop, except that
+        # out-of-bounds crops are clamped instead of re-sampled
+        theta = torch.zeros(n, 2, 3)
+        if self.crop:
+            area = self.uniform(n, *self.scale) * height * width
+            ratio = torch.exp(self.uniform(n, *self.log_ratio))
+            w = torch.sqrt(area * ratio).clamp(max=width)
+            h = torch.sqrt(area / ratio).clamp(max=height)
+            left = self.uniform(n, 0, 1) * (width - w)
+            top = self.uniform(n, 0, 1) * (height - h)
+            theta[:, 0, 0] = w / width
+            theta[:, 0, 2] = (2 * left + w) / width - 1
+            theta[:, 1, 1] = h / height
+            theta[:, 1, 2] = (2 * top + h) / height - 1
+        else:
+            theta[:, 0, 0] = 1
+            theta[:, 1, 1] = 1
+        if self.flip:
+            flip = (torch.rand(n, generator=self.generator) < 0.5).float()
+            theta[:, 0, 0] *= 1 - 2 * flip
+        return theta
+
+    def __call__(self, x, seed=None):
+        # x: uint8 batch (N, C, H, W), already on the training device
+        if seed is not None:
+            self.generator.manual_seed(seed + self.SEED_OFFSET)
+        n, c, height, width = x.size()
+        x = x.float().div_(255)
+        if self.crop or self.flip:
+            theta = self.get_theta(n, height, width).to(x.device)
+            size = self.image_size if self.crop else height
+            grid = F.affine_grid(
+                theta, (n, c, size, size), align_corners=False)
+            x = F.grid_sample(
+                x,
+                grid,
+                mode='bilinear',
+                padding_mode='border',
+                align_corners=False)
+        mean = x.new_tensor(self.mean).view(1, -1, 1, 1)
+        std = x.new_tensor(self.std).view(1, -1, 1, 1)
+        return (x - mean) / std
@@ -0,0 +1,153 @@
+"""Microbenchmarks.
+
+    $ python -m misc.benchmark adain --batch_size=16
+    $ python -m misc.benchmark train --batch_size=8 --image_size=128
+
+train accepts the options of main.py (model size, --amp, ...) and times
+one training step on random data, split (D and G on half of the batch
+each) and with --fused_step. Running it with and without --accum_steps
+compares the peak memory and the cost of the micro-batches.
+"""
+import os
+import sys
+import time
+import argparse
+import torch
+import torch.nn.functional as F
+
+
+# ==================================================================#
+# ==================================================================#
+def adain_reference(x, weight, bias, eps=1e-5, momentum=0.1):
+    # AdaptiveInstanceNorm2d.forward before the dummy buffers were removed
+    b, c = x.size(0), x.size(1)
+    running_mean = torch.zeros(c).repeat(b)
+    running_var = torch.ones(c).repeat(b)
+    x_reshaped = x.contiguous().view(1, b * c, *x.size()[2:])
+    out = F.batch_norm(x_reshaped, running_mean, running_var, weight, bias,
+                       True, momentum, eps)
+    return out.view(b, c, *x.size()[2:])
+
+
+# ==================================================================#
+# ==================================================================#
+def timeit(fn, repeat=50, warmup=5):
+    for _ in range(warmup):
+        fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+# ==================================================================#
+# ==================================================================#
+def adain(batch_size=16, dim=128, size=32, repeat=50):
+    from misc.blocks import AdaptiveInstanceNorm2d
+    x = torch.randn(batch_size, dim, size, size, requires_grad=True)
+    weight = torch.randn(batch_size * dim)
+    bias = torch.randn(batch_size * dim)
+    norm = AdaptiveInstanceNorm2d(dim)
+    norm.weight, norm.bias = weight, bias
+
+    def reference():
+        return adain_reference(x, weight, bias)
+
+    diff = (reference() - norm(x)).abs().max().item()
+    print('AdaIN x: {} | max abs diff: {:.2e}'.format(
+        tuple(x.size()), diff))
+    for name, fn in [('reference', reference), ('AdaIN', lambda: norm(x))]:
+        with torch.no_grad():
+            forward = timeit(fn, repeat=repeat)
+        backward = timeit(lambda: fn().sum().backward(), repeat=repeat)
+        print('{:>10}: forward {:.3f} ms | forward+backward {:.3f} ms'.format(
+            name, forward, backward))
+
+
+# ==================================================================#
+# ==================================================================#
+def train_config(argv):
+    # Options as in main.py, without folders or log files
+    from misc.options import base_parser
+    from misc.utils import config_yaml
+    _argv, sys.argv = sys.argv, sys.argv[:1] + argv
+    config = base_parser()
+    sys.argv = _argv
+    config_yaml(config, 'datasets/{}.yaml'.format(config.dataset_fake))
+    config.batch_size *= 2  # RaGAN
+    config.mode = 'train'
+    config.pretrained_model = ''
+    config.log = open(os.devnull, 'w')
+    return config
+
+
+def train(config, repeat=20):
+    from train import Train
+
+    class Step(Train):
+        # Models and optimizers, without the training loop
+        def run(self):
+            pass
+
+    solver = Step(config, None)
+    size = (config.batch_size, config.color_dim, config.image_size,
+            config.image_size)
+    real_x = torch.rand(*size) * 2 - 1
+    real_c = torch.eye(config.c_dim)[torch.randint(
+        0, config.c_dim, (config.batch_size, ))]
+    forwards = [0]
+
+    def count(*args):
+        forwards[0] += 1
+
+    solver.G.register_forward_pre_hook(count)
+    cuda = torch.cuda.is_available()
+
+    def step(real_x, real_c):
+        solver.loss = {}
+        solver.LOSS = {}
+        solver.train_step(real_x, real_c, 0)
+        if cuda:
+            torch.cuda.synchronize()
+
+    print('Train step | batch: {} | image size: {} | accum steps: {}'.format(
+        config.batch_size, config.image_size, config.accum_steps))
+    half = config.batch_size // 2
+    # split and fused/2 train D and G with the same number of images
+    for name, fused, batch in [('split', False, config.batch_size),
+                               ('fused', True, config.batch_size),
+                               ('fused/2', True, half)]:
+        config.fused_step = fused
+        inputs = (real_x[:batch], real_c[:batch])
+        step(*inputs)
+        if cuda:
+            torch.cuda.reset_max_memory_allocated()
+        forwards[0] = 0
+        elapsed = timeit(lambda: step(*inputs), repeat=repeat, warmup=0)
+        memory = 'peak memory {:.0f} MB'.format(
+            torch.cuda.max_memory_allocated() / 2.**20) if cuda else ''
+        print('{:>7}: {:.1f} images/sec | D/G batch {} | {:.0f} G forwards'
+              '/step | {}'.format(name, batch * 1000. / elapsed,
+                                  batch if fused else half,
+                                  forwards[0] / float(repeat), memory))
+
+
+# ==================================================================#
+# ==================================================================#
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('bench', type=str, choices=['adain', 'train'])
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--size', type=int, default=32)
+    parser.add_argument('--repeat', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=0)
+    args, argv = parser.parse_known_args()
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    if args.bench == 'adain':
+        adain(args.batch_size, args.dim, args.size, args.repeat)
+    elif args.bench == 'train':
+        train(
+            train_config(['--batch_size', str(args.batch_size)] + argv),
+            args.repeat)
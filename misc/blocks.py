@@ -15,23 +15,31 @@ class AdaptiveInstanceNorm2d(nn.Module):
         # weight and bias are dynamically assigned
         self.weight = None
         self.bias = None
-        # just dummy buffers, not used
-        self.register_buffer('running_mean', torch.zeros(num_features))
-        self.register_buffer('running_var', torch.ones(num_features))
 
-    def forward(self, x):
-        assert self.weight is not None and self.bias is not None, \
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints have the unused running_mean/running_var buffers
+        for key in ['running_mean', 'running_var']:
+            state_dict.pop(prefix + key, None)
+        super(AdaptiveInstanceNorm2d, self)._load_from_state_dict(
+            state_dict, prefix, *args, **kwargs)
+
+    def forward(self, x, weight=None, bias=None):
+        # weight and bias (b * c) are given by the caller, otherwise the
+        # ones assigned to the module are used
+        if weight is None or bias is None:
+            weight, bias = self.weight, self.bias
+        assert weight is not None and bias is not None, \
             "Please assign weight and bias before calling AdaIN!"
         b, c = x.size(0), x.size(1)
-        running_mean = self.running_mean.repeat(b)
-        running_var = self.running_var.repeat(b)
-
-        # Apply instance norm
-        x_reshaped = x.contiguous().view(1, b * c, *x.size()[2:])
 
-        out = F.batch_norm(x_reshaped, running_mean, running_var, self.weight,
-                           self.bias, True, self.momentum, self.eps)
-        return out.view(b, c, *x.size()[2:])
+        # Apply instance norm as a single batch norm over (1, b * c, H, W),
+        # with the per-sample affine fused and no running statistics. The
+        # reshape is a view unless x is not contiguous. Statistics in fp32
+        # under --amp.
+        x_reshaped = x.reshape(1, b * c, *x.size()[2:]).float()
+        out = F.batch_norm(x_reshaped, None, None, weight.float(),
+                           bias.float(), True, self.momentum, self.eps)
+        return out.view(b, c, *x.size()[2:]).type_as(x)
 
     def __repr__(self):
         return self.__class__.__name__ + '(' + str(self.num_features) + ')'
@@ -44,6 +52,7 @@ class ResidualBlock(nn.Module):
 
     def __init__(self, dim_in, dim_out, AdaIn=False):
         super(ResidualBlock, self).__init__()
+        self.AdaIn = AdaIn
         if AdaIn:
             norm1 = AdaptiveInstanceNorm2d(dim_out)
             norm2 = AdaptiveInstanceNorm2d(dim_out)
@@ -67,8 +76,18 @@ class ResidualBlock(nn.Module):
                 padding=1,
                 bias=False), norm2)
 
-    def forward(self, x):
-        return x + self.main(x)
+    def forward(self, x, de_params=None):
+        # de_params: (weight, bias) for each AdaIN layer, in order
+        if de_params is None:
+            return x + self.main(x)
+        de_params = iter(de_params)
+        out = x
+        for layer in self.main:
+            if isinstance(layer, AdaptiveInstanceNorm2d):
+                out = layer(out, *next(de_params))
+            else:
+                out = layer(out)
+        return x + out
 
 
 # ==================================================================#
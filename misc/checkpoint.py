@@ -0,0 +1,125 @@
+"""Checkpoints written in the background.
+
+CheckpointWriter.save only copies the state dicts to CPU memory (pinned,
+with asynchronous copies, when CUDA is available) on the calling thread. A
+single writer thread waits for the copies and serializes them. Each file is
+written to a temporary name and moved in place with os.replace, in the
+given order: Solver.save puts G last, so a *_G.pth (what resume_name looks
+for) is always complete and comes with its D, optimizer and training state
+files. The writer also removes the checkpoints pruned by --model_epoch.
+
+rng_state/set_rng_state cover the generators of torch (CPU and CUDA), NumPy
+and random, for the training state used to resume (Train.train_state).
+"""
+import os
+import atexit
+import queue
+import random
+import threading
+import numpy as np
+import torch
+
+
+def rng_state():
+    # Tensors and Python types only, loadable with torch.load(weights_only)
+    numpy_state = np.random.get_state()
+    state = {
+        'torch': torch.get_rng_state(),
+        'numpy': (numpy_state[0], torch.from_numpy(
+            numpy_state[1].astype(np.int64))) + tuple(numpy_state[2:]),
+        'random': random.getstate()
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    torch.set_rng_state(state['torch'])
+    numpy_state = state['numpy']
+    np.random.set_state((numpy_state[0], numpy_state[1].numpy().astype(
+        np.uint32)) + tuple(numpy_state[2:]))
+    random.setstate(state['random'])
+    if 'cuda' in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def snapshot(state, pin=False):
+    # Copy of the tensors in nested dicts/lists, the rest is kept as is
+    if torch.is_tensor(state):
+        if state.is_cuda:
+            cpu = torch.empty(
+                state.size(), dtype=state.dtype, pin_memory=pin)
+            return cpu.copy_(state.detach(), non_blocking=pin)
+        return state.detach().clone()
+    if isinstance(state, dict):
+        return type(state)(
+            (key, snapshot(value, pin)) for key, value in state.items())
+    if isinstance(state, (list, tuple)):
+        return type(state)(snapshot(value, pin) for value in state)
+    return state
+
+
+# ==================================================================#
+# ==================================================================#
+class CheckpointWriter(object):
+    def __init__(self, pending=1):
+        # At most pending snapshots wait for the writer, save blocks after
+        self.queue = queue.Queue(maxsize=pending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def save(self, files, remove=()):
+        # files: [(name, state_dict)] written in this order, remove: names
+        # deleted once they are written
+        self.check()
+        pin = torch.cuda.is_available()
+        files = [(name, snapshot(state, pin)) for name, state in files]
+        event = None
+        if pin:
+            event = torch.cuda.Event()
+            event.record()
+        self.queue.put((files, list(remove), event))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                self.write(*item)
+            except Exception as error:
+                self.error = error
+            finally:
+                self.queue.task_done()
+
+    def write(self, files, remove, event):
+        if event is not None:
+            event.synchronize()
+        for name, state in files:
+            tmp_name = name + '.tmp'
+            torch.save(state, tmp_name)
+            os.replace(tmp_name, name)
+        for name in remove:
+            if os.path.isfile(name):
+                os.remove(name)
+
+    def check(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def flush(self):
+        # Waits for every checkpoint saved so far
+        self.queue.join()
+        self.check()
+
+    def close(self):
+        if not self.thread.is_alive():
+            return
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
@@ -9,6 +9,10 @@ When run as a stand-alone program, it compares the distribution of
 images that are stored as PNG/JPEG at a specified location with a
 distribution given by summary statistics (in pickle format).
 
+Images in a folder are decoded by DataLoader workers and the mean and
+covariance are accumulated batch by batch (RunningStatistics), so memory
+stays O(dims^2) regardless of the number of images.
+
 The FID is calculated by assuming that X_1 and X_2 are the activations of
 the pool_3 layer of the inception net for generated samples and real world
 samples respectively.
@@ -37,7 +41,7 @@ import pathlib
 
 import torch
 import numpy as np
-from scipy.misc import imread
+from PIL import Image
 from scipy import linalg
 from torch.autograd import Variable
 from torch.nn.functional import adaptive_avg_pool2d
@@ -112,13 +116,273 @@ def get_activations(images,
     return pred_arr
 
 
+class ImageFiles(torch.utils.data.Dataset):
+    """Images as float tensors (3, hi, wi) between 0 and 1"""
+
+    def __init__(self, files):
+        self.files = files
+
+    def __getitem__(self, index):
+        image = Image.open(str(self.files[index])).convert('RGB')
+        image = np.asarray(image, dtype=np.float32).transpose((2, 0, 1))
+        return torch.from_numpy(image / 255)
+
+    def __len__(self):
+        return len(self.files)
+
+
+class RunningStatistics(object):
+    """Mean and covariance of activations, updated batch by batch in
+    float64 (Chan et al. parallel update of the mean and the sum of
+    squared deviations). Equal to np.mean and np.cov of all the rows."""
+
+    def __init__(self, dims=2048):
+        self.n = 0
+        self.mu = np.zeros(dims, dtype=np.float64)
+        self.m2 = np.zeros((dims, dims), dtype=np.float64)
+
+    def update(self, act):
+        act = np.asarray(act, dtype=np.float64)
+        n = act.shape[0]
+        if n == 0:
+            return self
+        mu = act.mean(axis=0)
+        centered = act - mu
+        delta = mu - self.mu
+        total = self.n + n
+        self.m2 += centered.T.dot(centered)
+        self.m2 += np.outer(delta, delta) * (self.n * n / float(total))
+        self.mu += delta * (n / float(total))
+        self.n = total
+        return self
+
+    def merge(self, other):
+        # Statistics of the union, e.g. from several workers
+        if other.n == 0:
+            return self
+        delta = other.mu - self.mu
+        total = self.n + other.n
+        self.m2 += other.m2 + np.outer(delta, delta) * (
+            self.n * other.n / float(total))
+        self.mu += delta * (other.n / float(total))
+        self.n = total
+        return self
+
+    @property
+    def sigma(self):
+        return self.m2 / (self.n - 1)
+
+
+class ActivationStatistics(RunningStatistics):
+    """RunningStatistics that also keeps a uniform random sample (reservoir)
+    of at most keep activations, for the KID"""
+
+    def __init__(self, dims=2048, keep=1000, seed=0):
+        super(ActivationStatistics, self).__init__(dims)
+        self.keep = keep
+        self.act = np.empty((0, dims), dtype=np.float32)
+        self.rng = np.random.RandomState(seed)
+
+    def update(self, act):
+        act = np.asarray(act, dtype=np.float64)
+        seen = self.n
+        super(ActivationStatistics, self).update(act)
+        free = max(self.keep - self.act.shape[0], 0)
+        if free:
+            self.act = np.concatenate([self.act, act[:free]]).astype(
+                np.float32)
+            seen += min(free, act.shape[0])
+            act = act[free:]
+        if act.shape[0]:
+            # Row k replaces a random slot with probability keep / (seen + k)
+            index = self.rng.randint(0, seen + 1 + np.arange(act.shape[0]))
+            replace = index < self.keep
+            self.act[index[replace]] = act[replace]
+        return self
+
+    def merge(self, other):
+        super(ActivationStatistics, self).merge(other)
+        if other.act.shape[0] == 0:
+            return self
+        # Sample of the union, drawing from each side in proportion to the
+        # number of activations it stands for
+        keep = min(self.keep, self.act.shape[0] + other.act.shape[0])
+        take = self.rng.binomial(keep, other.n / float(self.n))
+        take = min(max(take, keep - self.act.shape[0]), other.act.shape[0])
+        mine = self.rng.choice(self.act.shape[0], keep - take, replace=False)
+        theirs = self.rng.choice(other.act.shape[0], take, replace=False)
+        self.act = np.concatenate([self.act[mine], other.act[theirs]])
+        return self
+
+
+def statistics_path(dataset, split, image_size, dims, cache_dir='scores'):
+    # Cached statistics of real images
+    return os.path.join(
+        cache_dir, 'FID_{}_{}_{}_{}.npz'.format(dataset, split, image_size,
+                                                dims))
+
+
+def save_statistics(path, statistics):
+    """Saves {key: ActivationStatistics} in a single npz"""
+    arrays = {}
+    for key, stats in statistics.items():
+        if stats.n < 2:
+            continue
+        arrays['mu_{}'.format(key)] = stats.mu
+        arrays['sigma_{}'.format(key)] = stats.sigma
+        arrays['act_{}'.format(key)] = stats.act
+        arrays['sqrt_{}'.format(key)] = FrechetReference(
+            stats.mu, stats.sigma).sqrt_sigma
+    tmp_name = path + '.tmp.npz'
+    np.savez(tmp_name, **arrays)
+    os.rename(tmp_name, path)
+
+
+def load_statistics(path):
+    """{key: (mu, sigma, act)} from save_statistics, integer keys when
+    possible"""
+    statistics = {}
+    f = np.load(path)
+    for name in f.files:
+        if not name.startswith('mu_'):
+            continue
+        key = name[3:]
+        stats = (f[name], f['sigma_' + key], f['act_' + key])
+        statistics[int(key) if key.isdigit() else key] = stats
+    f.close()
+    return statistics
+
+
+# FrechetReference per statistics file, {path: (mtime, references)}
+_REFERENCES = {}
+
+
+def load_references(path):
+    """{key: FrechetReference} of the statistics of save_statistics. The
+    square roots of the covariances are read from the file (added to older
+    files once), and the references are kept for the next calls with the
+    same, unchanged file."""
+    mtime = os.stat(path).st_mtime
+    if path in _REFERENCES and _REFERENCES[path][0] == mtime:
+        return _REFERENCES[path][1]
+    f = np.load(path)
+    arrays = {name: f[name] for name in f.files}
+    f.close()
+    references = {}
+    missing = False
+    for name in list(arrays.keys()):
+        if not name.startswith('mu_'):
+            continue
+        key = name[3:]
+        if 'sqrt_' + key not in arrays:
+            missing = True
+        reference = FrechetReference(arrays[name], arrays['sigma_' + key],
+                                     arrays.get('sqrt_' + key))
+        arrays['sqrt_' + key] = reference.sqrt_sigma
+        references[int(key) if key.isdigit() else key] = reference
+    if missing:
+        tmp_name = path + '.tmp.npz'
+        np.savez(tmp_name, **arrays)
+        os.rename(tmp_name, path)
+        mtime = os.stat(path).st_mtime
+    _REFERENCES[path] = (mtime, references)
+    return references
+
+
+def get_batch_activations(batch, model, cuda=False):
+    """Activations (batch size, dims) for a float tensor batch between 0
+    and 1"""
+    with torch.no_grad():
+        if cuda:
+            batch = batch.cuda()
+        pred = model(batch)[0]
+
+        # If model output is not scalar, apply global spatial average pooling.
+        # This happens if you choose a dimensionality not equal 2048.
+        if pred.shape[2] != 1 or pred.shape[3] != 1:
+            pred = adaptive_avg_pool2d(pred, output_size=(1, 1))
+
+    return pred.cpu().numpy().reshape(pred.size(0), -1)
+
+
+def calculate_loader_statistics(loader, model, dims=2048, cuda=False,
+                                verbose=False):
+    """Streaming calculation of the statistics used by the FID.
+    Params:
+    -- loader      : Iterable of float tensor batches (B, 3, hi, wi) between
+                     0 and 1, e.g. a DataLoader over ImageFiles.
+    Returns:
+    -- mu, sigma as in calculate_activation_statistics
+    """
+    model.eval()
+    stats = RunningStatistics(dims)
+    for i, batch in enumerate(loader):
+        if verbose:
+            print('\rPropagating batch %d' % (i + 1), end='', flush=True)
+        stats.update(get_batch_activations(batch, model, cuda))
+    if verbose:
+        print(' done')
+    return stats.mu, stats.sigma
+
+
+class FrechetReference(object):
+    """Reference statistics for the Frechet distance.
+
+    With A = sqrt(C_2), Tr(sqrt(C_1*C_2)) = Tr(sqrt(A*C_1*A)), and A*C_1*A is
+    symmetric positive semi-definite: the trace is the sum of the square
+    roots of its eigenvalues. A is computed once from the eigen-decomposition
+    of C_2 (or given, see load_references), then each distance only needs
+    eigvalsh, which is faster and more stable than scipy.linalg.sqrtm and
+    never complex.
+    """
+
+    def __init__(self, mu, sigma, sqrt_sigma=None):
+        self.mu = np.atleast_1d(np.asarray(mu, dtype=np.float64))
+        sigma = np.atleast_2d(np.asarray(sigma, dtype=np.float64))
+        if sqrt_sigma is None:
+            w, v = linalg.eigh(sigma)
+            sqrt_sigma = (v * np.sqrt(np.clip(w, 0, None))).dot(v.T)
+        self.sqrt_sigma = np.asarray(sqrt_sigma, dtype=np.float64)
+        self.trace = np.trace(sigma)
+
+    def __call__(self, mu, sigma):
+        return self.batch([(mu, sigma)])[0]
+
+    def batch(self, statistics):
+        """Distances of a list of (mu, sigma) to the reference, as an array
+        with one distance per item"""
+        mu = np.stack([
+            np.atleast_1d(np.asarray(m, dtype=np.float64))
+            for m, _ in statistics
+        ])
+        sigma = np.stack([
+            np.atleast_2d(np.asarray(s, dtype=np.float64))
+            for _, s in statistics
+        ])
+        assert mu.shape[1:] == self.mu.shape, \
+            'Training and test mean vectors have different lengths'
+        assert sigma.shape[1:] == self.sqrt_sigma.shape, \
+            'Training and test covariances have different dimensions'
+        diff = mu - self.mu
+        product = np.matmul(np.matmul(self.sqrt_sigma, sigma),
+                            self.sqrt_sigma)
+        # Symmetric up to rounding
+        product = (product + product.transpose(0, 2, 1)) / 2
+        eigenvalues = np.linalg.eigvalsh(product)
+        tr_covmean = np.sqrt(np.clip(eigenvalues, 0, None)).sum(1)
+        return ((diff * diff).sum(1) + np.trace(sigma, axis1=1, axis2=2) +
+                self.trace - 2 * tr_covmean)
+
+
 def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     """Numpy implementation of the Frechet Distance.
     The Frechet distance between two multivariate Gaussians X_1 ~ N(mu_1, C_1)
     and X_2 ~ N(mu_2, C_2) is
             d^2 = ||mu_1 - mu_2||^2 + Tr(C_1 + C_2 - 2*sqrt(C_1*C_2)).
 
-    Stable version by Dougal J. Sutherland.
+    Computed with eigen-decompositions (see FrechetReference), use a
+    FrechetReference directly to score several statistics against the same
+    reference.
 
     Params:
     -- mu1   : Numpy array containing the activations of a layer of the
@@ -129,44 +393,41 @@ def calculate_frechet_distance(mu1, sigma1, mu2, sigma2, eps=1e-6):
     -- sigma1: The covariance matrix over activations for generated samples.
     -- sigma2: The covariance matrix over activations, precalculated on an
                representative data set.
+    -- eps   : Unused, the eigen-decomposition does not need the diagonal
+               offset of the sqrtm version.
 
     Returns:
     --   : The Frechet Distance.
     """
-
     mu1 = np.atleast_1d(mu1)
-    mu2 = np.atleast_1d(mu2)
-
     sigma1 = np.atleast_2d(sigma1)
-    sigma2 = np.atleast_2d(sigma2)
-
-    assert mu1.shape == mu2.shape, \
-        'Training and test mean vectors have different lengths'
-    assert sigma1.shape == sigma2.shape, \
-        'Training and test covariances have different dimensions'
-
-    diff = mu1 - mu2
+    return float(FrechetReference(mu2, sigma2)(mu1, sigma1))
 
-    # Product might be almost singular
-    covmean, _ = linalg.sqrtm(sigma1.dot(sigma2), disp=False)
-    if not np.isfinite(covmean).all():
-        msg = ('fid calculation produces singular product; '
-               'adding %s to diagonal of cov estimates') % eps
-        print(msg)
-        offset = np.eye(sigma1.shape[0]) * eps
-        covmean = linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
 
-    # Numerical error might give slight imaginary component
-    if np.iscomplexobj(covmean):
-        if not np.allclose(np.diagonal(covmean).imag, 0, atol=1e-3):
-            m = np.max(np.abs(covmean.imag))
-            raise ValueError('Imaginary component {}'.format(m))
-        covmean = covmean.real
-
-    tr_covmean = np.trace(covmean)
-
-    return (
-        diff.dot(diff) + np.trace(sigma1) + np.trace(sigma2) - 2 * tr_covmean)
+def calculate_kid(act1, act2, n_subsets=10, subset_size=1000, seed=0):
+    """Kernel Inception Distance: unbiased estimate of the MMD^2 between
+    activations with the kernel k(x, y) = (x.y / dims + 1)^3.
+    Returns:
+    --   : Mean and std over n_subsets random subsets of subset_size.
+    """
+    n = min(act1.shape[0], act2.shape[0], subset_size)
+    if n < 2:
+        return float('nan'), float('nan')
+    dims = act1.shape[1]
+    rng = np.random.RandomState(seed)
+    mmd = []
+    for _ in range(n_subsets):
+        x = act1[rng.choice(act1.shape[0], n, replace=False)]
+        y = act2[rng.choice(act2.shape[0], n, replace=False)]
+        x = np.asarray(x, dtype=np.float64)
+        y = np.asarray(y, dtype=np.float64)
+        kxx = (x.dot(x.T) / dims + 1)**3
+        kyy = (y.dot(y.T) / dims + 1)**3
+        kxy = (x.dot(y.T) / dims + 1)**3
+        mmd.append(
+            (kxx.sum() - np.trace(kxx) + kyy.sum() - np.trace(kyy)) /
+            (n * (n - 1)) - 2 * kxy.mean())
+    return float(np.mean(mmd)), float(np.std(mmd))
 
 
 def calculate_activation_statistics(images,
@@ -199,7 +460,12 @@ def calculate_activation_statistics(images,
     return mu, sigma
 
 
-def _compute_statistics_of_path(path, model, batch_size, dims, cuda):
+def _compute_statistics_of_path(path,
+                                model,
+                                batch_size,
+                                dims,
+                                cuda,
+                                num_workers=4):
     if path.endswith('.npz'):
         f = np.load(path)
         m, s = f['mu'][:], f['sigma'][:]
@@ -208,22 +474,19 @@ def _compute_statistics_of_path(path, model, batch_size, dims, cuda):
         path = pathlib.Path(path)
         files = list(path.glob('*.jpg')) + list(path.glob('*.png'))
 
-        imgs = np.array([imread(str(fn)).astype(np.float32) for fn in files])
-
-        # Bring images to shape (B, 3, H, W)
-        imgs = imgs.transpose((0, 3, 1, 2))
-
-        # Rescale images to be between 0 and 1
-        imgs /= 255
-
-        m, s = calculate_activation_statistics(imgs, model, batch_size, dims,
-                                               cuda)
+        loader = torch.utils.data.DataLoader(
+            ImageFiles(files),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            pin_memory=cuda)
+        m, s = calculate_loader_statistics(loader, model, dims, cuda)
 
     return m, s
 
 
-def calculate_fid_given_paths(paths, batch_size, cuda, dims):
-    """Calculates the FID of two paths"""
+def calculate_fid_given_paths(paths, batch_size, cuda, dims, num_workers=4):
+    """Calculates the FID of two paths, or of every other path to the first
+    one (a list) with more than two"""
     for p in paths:
         if not os.path.exists(p):
             raise RuntimeError('Invalid path: %s' % p)
@@ -234,13 +497,14 @@ def calculate_fid_given_paths(paths, batch_size, cuda, dims):
     if cuda:
         model.cuda()
 
-    m1, s1 = _compute_statistics_of_path(paths[0], model, batch_size, dims,
-                                         cuda)
-    m2, s2 = _compute_statistics_of_path(paths[1], model, batch_size, dims,
-                                         cuda)
-    fid_value = calculate_frechet_distance(m1, s1, m2, s2)
-
-    return fid_value
+    statistics = [
+        _compute_statistics_of_path(path, model, batch_size, dims, cuda,
+                                    num_workers) for path in paths
+    ]
+    fid_values = FrechetReference(*statistics[0]).batch(statistics[1:])
+    if len(paths) == 2:
+        return float(fid_values[0])
+    return fid_values.tolist()
 
 
 if __name__ == '__main__':
@@ -249,9 +513,10 @@ if __name__ == '__main__':
     parser.add_argument(
         'path',
         type=str,
-        nargs=2,
+        nargs='+',
         help=('Path to the generated images or '
-              'to .npz statistic files'))
+              'to .npz statistic files, the FID of every path to the '
+              'first one is reported'))
     parser.add_argument(
         '--batch-size', type=int, default=64, help='Batch size to use')
     parser.add_argument(
@@ -261,6 +526,11 @@ if __name__ == '__main__':
         choices=list(InceptionV3.BLOCK_INDEX_BY_DIM),
         help=('Dimensionality of Inception features to use. '
               'By default, uses pool3 features'))
+    parser.add_argument(
+        '--num-workers',
+        type=int,
+        default=4,
+        help='Workers decoding the images')
     parser.add_argument(
         '-c',
         '--gpu',
@@ -270,6 +540,12 @@ if __name__ == '__main__':
     args = parser.parse_args()
     os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu
 
-    fid_value = calculate_fid_given_paths(args.path, args.batch_size,
-                                          args.gpu != '', args.dims)
-    print('FID: ', fid_value)
+    if len(args.path) < 2:
+        parser.error('at least two paths are needed')
+    fid_values = calculate_fid_given_paths(args.path, args.batch_size,
+                                           args.gpu != '', args.dims,
+                                           args.num_workers)
+    if len(args.path) == 2:
+        fid_values = [fid_values]
+    for path, fid_value in zip(args.path[1:], fid_values):
+        print('FID {}: '.format(path), fid_value)
@@ -0,0 +1,69 @@
+"""On-disk cache of decoded and resized images.
+
+get_loader always starts the transform with a deterministic Resize of the
+full-resolution image, the most expensive step per sample, whose output
+never changes across epochs. CachedDataset wraps a dataset, runs decode and
+Resize once per file, stores the uint8 result under cache_dir keyed by
+source file, size and mtime, and only applies the remaining (random)
+transforms afterwards.
+"""
+import os
+import hashlib
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+
+# ==================================================================#
+# == Resize Cache
+# ==================================================================#
+class CachedDataset(Dataset):
+    def __init__(self, dataset, resize, cache_dir):
+        self.dataset = dataset
+        self.resize = resize
+        self.cache_dir = cache_dir
+        self.size = '{}x{}'.format(*resize.size) if isinstance(
+            resize.size, (list, tuple)) else str(resize.size)
+
+    def __getattr__(self, name):
+        # Everything else (labels, selected_attrs, shuffle...) belongs to the
+        # wrapped dataset
+        if name == 'dataset':
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def cache_file(self, filename):
+        key = '{}:{}:{}'.format(
+            os.path.abspath(filename), self.size,
+            os.stat(filename).st_mtime)
+        key = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, key[:2], key + '.npy')
+
+    def load(self, filename):
+        cache_file = self.cache_file(filename)
+        if os.path.isfile(cache_file):
+            return Image.fromarray(np.load(cache_file))
+        image = self.resize(Image.open(filename).convert('RGB'))
+        if not os.path.isdir(os.path.dirname(cache_file)):
+            try:
+                os.makedirs(os.path.dirname(cache_file))
+            except OSError:
+                pass  # Created by another worker
+        # Atomic, workers and ranks may be writing the same file
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as f:
+            np.save(f, np.asarray(image, dtype=np.uint8))
+        os.rename(tmp_file, cache_file)
+        return image
+
+    def __getitem__(self, index):
+        filename = self.dataset.filenames[index]
+        label = self.dataset.labels[index]
+        image = self.load(filename)
+        # dataset.transform holds the remaining (random) transforms
+        return self.dataset.transform(image), torch.FloatTensor(
+            label), filename
+
+    def __len__(self):
+        return len(self.dataset)
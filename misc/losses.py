@@ -32,11 +32,18 @@ def _CLS_L2(output, target):
 # ==================================================================#
 # ==================================================================#
 def _GAN_LOSS(Disc, real_x, fake_x, label, cross_entropy=False):
-    import torch
-    import torch.nn.functional as F
     src_real, cls_real = Disc(real_x)
     src_fake, _ = Disc(fake_x)
+    return _RaGAN_LOSS(
+        src_real, cls_real, src_fake, label, cross_entropy=cross_entropy)
 
+
+# ==================================================================#
+# ==================================================================#
+def _RaGAN_LOSS(src_real, cls_real, src_fake, label, cross_entropy=False):
+    # Loss on the outputs of the discriminator (one per scale)
+    import torch
+    import torch.nn.functional as F
     loss_src = 0
     loss_cls = 0
     for i in range(len(src_real)):
@@ -2,6 +2,7 @@ from __future__ import absolute_import
 
 import torch
 import torch.nn as nn
+from collections import OrderedDict
 from misc.utils import to_var
 from . import pretrained_networks as pn
 from misc.lpips import util
@@ -141,63 +142,71 @@ class PNetLin(nn.Module):
                 self.lin5.cuda()
                 self.lin6.cuda()
 
-    def forward(self, in0, in1):
-        in0_sc = (in0 - self.shift.expand_as(in0)) / self.scale.expand_as(in0)
-        in1_sc = (in1 - self.shift.expand_as(in0)) / self.scale.expand_as(in0)
-
+    def extract(self, in0):
+        # Normalized features of every layer of the backbone
         if (self.version == '0.0'):
             # v0.0 - original release had a bug, where input was not scaled
             in0_input = in0
-            in1_input = in1
         else:
             # v0.1
-            in0_input = in0_sc
-            in1_input = in1_sc
+            in0_input = (in0 - self.shift.expand_as(in0)) / \
+                self.scale.expand_as(in0)
 
         if (self.pnet_tune):
             outs0 = self.net.forward(in0_input)
-            outs1 = self.net.forward(in1_input)
         else:
             outs0 = self.net[0].forward(in0_input)
-            outs1 = self.net[0].forward(in1_input)
 
-        feats0 = {}
-        feats1 = {}
-        diffs = [0] * len(outs0)
+        return [util.normalize_tensor(out0) for out0 in outs0]
 
-        for (kk, out0) in enumerate(outs0):
-            feats0[kk] = util.normalize_tensor(outs0[kk])
-            feats1[kk] = util.normalize_tensor(outs1[kk])
-            diffs[kk] = (feats0[kk] - feats1[kk])**2
+    def distance(self, feats0, feats1):
+        # Distance between features from extract, pairwise along the batch
+        diffs = [(feat0 - feat1)**2 for feat0, feat1 in zip(feats0, feats1)]
 
         if self.spatial:
-            lin_models = [
-                self.lin0, self.lin1, self.lin2, self.lin3, self.lin4
-            ]
-            if (self.pnet_type == 'squeeze'):
-                lin_models.extend([self.lin5, self.lin6])
-            res = [lin_models[kk].model(diffs[kk]) for kk in range(len(diffs))]
+            res = [self.lins[kk].model(diffs[kk]) for kk in range(len(diffs))]
             return res
 
-        val = torch.mean(torch.mean(self.lin0.model(diffs[0]), dim=3), dim=2)
-        val = val + \
-            torch.mean(torch.mean(self.lin1.model(diffs[1]), dim=3), dim=2)
-        val = val + \
-            torch.mean(torch.mean(self.lin2.model(diffs[2]), dim=3), dim=2)
-        val = val + \
-            torch.mean(torch.mean(self.lin3.model(diffs[3]), dim=3), dim=2)
-        val = val + \
-            torch.mean(torch.mean(self.lin4.model(diffs[4]), dim=3), dim=2)
-        if (self.pnet_type == 'squeeze'):
-            val = val + \
-                torch.mean(torch.mean(self.lin5.model(diffs[5]), dim=3), dim=2)
-            val = val + \
-                torch.mean(torch.mean(self.lin6.model(diffs[6]), dim=3), dim=2)
+        val = 0
+        for kk in range(len(diffs)):
+            val = val + torch.mean(
+                torch.mean(self.lins[kk].model(diffs[kk]), dim=3), dim=2)
 
         val = val.view(val.size()[0], val.size()[1], 1, 1)
 
         return val
 
+    def forward(self, in0, in1):
+        return self.distance(self.extract(in0), self.extract(in1))
+
+
+class FeatureCache(object):
+    '''Bounded LRU of extracted features. The key is the identity of the
+    input tensor (kept referenced and checked against in-place changes) or
+    a key given by the caller, e.g. a content hash or a file name.'''
+
+    def __init__(self, size=64):
+        self.size = size
+        self.cache = OrderedDict()
+
+    def __call__(self, images, extract, key=None):
+        if key is None:
+            key = ('id', id(images))
+            tensor, version = images, getattr(images, '_version', 0)
+        else:
+            tensor, version = None, None
+        entry = self.cache.pop(key, None)
+        if entry is None or entry[0] is not tensor or entry[1] != version:
+            entry = (tensor, version, extract(images))
+        # Most recently used last
+        self.cache[key] = entry
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+        return entry[2]
+
+    def clear(self):
+        self.cache.clear()
+
 
 class Dist2LogitLayer(nn.Module):
     def __init__(self, chn_mid=32, use_sigmoid=True):
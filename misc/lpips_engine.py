@@ -0,0 +1,169 @@
+"""Pairwise LPIPS over a set of images.
+
+compute_lpips runs AlexNet on both images of every pair. PairwiseLPIPS runs
+it once per image instead: the normalized features of all the layers are
+flattened into a single row per image (in memory, or in a memory-mapped
+file for large sets), and, for the linear weights w_l of each layer,
+
+    d(i, j) = sum_l mean_hw sum_c w_lc (f_i - f_j)^2
+            = n_i + n_j - 2 (w * f_i) . f_j
+
+is evaluated for tile x tile blocks of pairs with one matrix product, or
+for all the pairs within groups of images (diversity) with a batched one.
+"""
+import os
+import math
+import tempfile
+import numpy as np
+import torch
+
+
+# ==================================================================#
+# ==================================================================#
+class PairwiseLPIPS(object):
+    def __init__(self, model, tile=256, store_dir=''):
+        # model: DistModel with a 'net-lin' network (compute_lpips)
+        self.net = model.net
+        self.tile = tile
+        self.store_dir = store_dir
+        self.store_file = None
+        self.weight = None
+        self.feats = None
+        self.norms = None
+        self.device = self.net.shift.device
+
+    def backbone(self, images):
+        outs = self.net.extract(images)
+        if self.weight is None:
+            # w_lc / (H_l * W_l) for every element of the flattened row
+            weight = []
+            for lin, out in zip(self.net.lins, outs):
+                size = out.size(2) * out.size(3)
+                w = lin.model[-1].weight.data.view(-1, 1) / size
+                weight.append(w.expand(-1, size).contiguous().view(-1))
+            self.weight = torch.cat(weight)
+        return torch.cat([out.view(out.size(0), -1) for out in outs], dim=1)
+
+    def embed(self, images):
+        # images in [-1, 1] -> (features, norms) on the device
+        with torch.no_grad():
+            feats = self.backbone(images.to(self.device))
+            norms = (feats * feats * self.weight).sum(1)
+        return feats, norms
+
+    def diversity(self, images):
+        # images (B, n, C, H, W): mean distance over the n(n-1)/2 pairs of
+        # each group of n, (B,) on the device
+        b, n = images.size(0), images.size(1)
+        feats, norms = self.embed(images.view(b * n, *images.size()[2:]))
+        feats = feats.view(b, n, -1)
+        norms = norms.view(b, n)
+        with torch.no_grad():
+            dist = norms.unsqueeze(2) + norms.unsqueeze(1) - \
+                2 * torch.bmm(feats * self.weight, feats.transpose(1, 2))
+        rows, cols = np.triu_indices(n, 1)
+        return dist[:, rows, cols].clamp(min=0).mean(1)
+
+    def alloc(self, size, dim):
+        if self.store_dir:
+            fd, self.store_file = tempfile.mkstemp(
+                suffix='.npy', dir=self.store_dir)
+            os.close(fd)
+            self.feats = np.lib.format.open_memmap(
+                self.store_file, mode='w+', dtype=np.float32,
+                shape=(size, dim))
+        else:
+            self.feats = np.empty((size, dim), dtype=np.float32)
+        self.norms = np.empty(size, dtype=np.float64)
+
+    def extract(self, batches, size):
+        # batches: iterable of image batches, size images in total
+        index = 0
+        for images in batches:
+            feats, norms = self.embed(images)
+            if self.feats is None:
+                self.alloc(size, feats.size(1))
+            self.feats[index:index + feats.size(0)] = feats.cpu().numpy()
+            self.norms[index:index + feats.size(0)] = norms.cpu().numpy()
+            index += feats.size(0)
+        assert index == size, 'Expected {} images, got {}'.format(
+            size, index)
+        return self
+
+    def rows(self, start, end):
+        feats = torch.from_numpy(np.ascontiguousarray(self.feats[start:end]))
+        norms = torch.from_numpy(self.norms[start:end]).float()
+        return feats.to(self.device), norms.to(self.device)
+
+    def blocks(self, rank=0, num_replicas=1):
+        # Upper triangle by blocks, including the diagonal ones:
+        # (rows, cols, distances) with distances[a, b] = d(rows[a], cols[b]).
+        # With several ranks, the k-th block goes to rank k % num_replicas.
+        size = self.norms.shape[0]
+        k = -1
+        for i in range(0, size, self.tile):
+            feats_i = None
+            for j in range(i, size, self.tile):
+                k += 1
+                if k % num_replicas != rank:
+                    continue
+                if feats_i is None:
+                    feats_i, norms_i = self.rows(i, i + self.tile)
+                    feats_i = feats_i * self.weight
+                    rows = torch.arange(
+                        i, i + feats_i.size(0), device=self.device)
+                feats_j, norms_j = self.rows(j, j + self.tile)
+                cols = torch.arange(
+                    j, j + feats_j.size(0), device=self.device)
+                dist = norms_i.view(-1, 1) + norms_j.view(1, -1) - \
+                    2 * torch.mm(feats_i, feats_j.t())
+                yield rows, cols, dist.clamp(min=0)
+
+    def close(self):
+        self.feats = None
+        if self.store_file is not None and os.path.isfile(self.store_file):
+            os.remove(self.store_file)
+        self.store_file = None
+
+
+# ==================================================================#
+# ==================================================================#
+class PairStats(object):
+    """Mean and std of distances per key, accumulated on the device"""
+
+    def __init__(self):
+        self.stats = {}
+
+    def add(self, key, distances, mask=None):
+        if mask is not None:
+            distances = distances[mask]
+        distances = distances.double()
+        stats = torch.stack([
+            distances.new_tensor(float(distances.numel())),
+            distances.sum(), (distances * distances).sum()
+        ])
+        if key in self.stats:
+            self.stats[key] = self.stats[key] + stats
+        else:
+            self.stats[key] = stats
+
+    def result(self, keys=None):
+        if keys is None:
+            keys = sorted(self.stats.keys())
+        keys = list(keys)
+        # Single copy to the host
+        found = [key for key in keys if key in self.stats]
+        stats = {}
+        if found:
+            values = torch.stack([self.stats[key] for key in found])
+            stats = dict(zip(found, values.cpu().tolist()))
+        result = {}
+        for key in keys:
+            count, total, squares = stats.get(key, (0, 0, 0))
+            if count == 0:
+                result[key] = (float('nan'), float('nan'))
+                continue
+            mean = total / count
+            result[key] = (mean,
+                           math.sqrt(max(squares / count - mean**2, 0)))
+        return result
@@ -3,8 +3,9 @@ from __future__ import absolute_import
 import numpy as np
 import torch
 import os
-from misc.utils import to_var
+from misc.utils import get_torch_version, to_var
 from misc.lpips.base_model import BaseModel
+from misc.lpips_engine import PairStats
 import skimage.transform
 # from IPython import embed
 
@@ -31,7 +32,8 @@ class DistModel(BaseModel):
                    is_train=False,
                    lr=.0001,
                    beta1=0.5,
-                   version='0.1'):
+                   version='0.1',
+                   cache_size=0):
         '''
         INPUTS
             model - ['net-lin'] for linearly calibrated network
@@ -59,6 +61,9 @@ class DistModel(BaseModel):
             lr - float - initial learning rate
             beta1 - float - initial momentum term for adam
             version - 0.1 for latest, 0.0 was original
+            cache_size - number of inputs whose features are kept by
+                    extract (net-lin only), 0 disables the cache. Only
+                    useful when the same inputs (or keys) come back.
         '''
         BaseModel.initialize(self, use_gpu=use_gpu)
 
@@ -72,6 +77,10 @@ class DistModel(BaseModel):
         self.spatial_factor = spatial_factor
 
         self.model_name = '%s [%s]' % (model, net)
+        # Distances of accumulate, on the device until total()
+        self.stats = PairStats()
+        self.feature_cache = networks.FeatureCache(
+            cache_size) if cache_size else None
         if (self.model == 'net-lin'):  # pretrained net + linear layer
             self.net = networks.PNetLin(
                 use_gpu=use_gpu,
@@ -137,6 +146,39 @@ class DistModel(BaseModel):
         else:
             return self.net.forward(in1, in2)
 
+    def extract(self, images, key=None):
+        ''' Normalized per-layer features of images (net-lin only)
+        INPUTS
+            images - torch.Tensor of shape Nx3xXxY scaled to [-1,1]
+            key - cache key, by default the identity of images
+        OUTPUT
+            list of features, reused from the last cache_size inputs if
+            the cache is enabled
+        '''
+
+        def extract(images):
+            if (self.use_gpu):
+                images = images.cuda()
+            return self.net.extract(images)
+
+        if self.feature_cache is None:
+            return extract(images)
+        return self.feature_cache(images, extract, key=key)
+
+    def distance(self, feats0, feats1):
+        ''' Distances between features from extract, as torch.Tensor '''
+        return self.net.distance(feats0, feats1)
+
+    def accumulate(self, in0, in1, key=0):
+        ''' forward without leaving the device, the distances are added to
+        the running statistics of key, read once at the end with total() '''
+        self.stats.add(key, self.forward(in0, in1, retNumpy=False).view(-1))
+
+    def total(self):
+        ''' {key: (mean, std)} of the accumulated distances, and reset '''
+        stats, self.stats = self.stats, PairStats()
+        return stats.result()
+
     def forward(self, in0, in1, retNumpy=True):
         ''' Function computes the distance between image patches in0 and in1
         INPUTS
@@ -155,10 +197,23 @@ class DistModel(BaseModel):
             self.input_ref = self.input_ref.cuda()
             self.input_p0 = self.input_p0.cuda()
 
-        self.var_ref = to_var(self.input_ref, requires_grad=True)
-        self.var_p0 = to_var(self.input_p0, requires_grad=True)
-
-        self.d0 = self.forward_pair(self.var_ref, self.var_p0)
+        if self.is_train:
+            self.var_ref = to_var(self.input_ref, requires_grad=True)
+            self.var_p0 = to_var(self.input_p0, requires_grad=True)
+            self.d0 = self.forward_pair(self.var_ref, self.var_p0)
+        else:
+            # Inference, no autograd graph
+            no_grad = open('/var/tmp/null.txt', 'w') \
+                if get_torch_version() < 1.0 else torch.no_grad()
+            with no_grad:
+                if self.model == 'net-lin':
+                    # Features of inputs seen recently are reused with
+                    # cache_size > 0
+                    self.d0 = self.distance(
+                        self.extract(in0), self.extract(in1))
+                else:
+                    self.d0 = self.forward_pair(self.input_ref,
+                                                self.input_p0)
         self.loss_total = self.d0
 
         def convert_output(d0):
@@ -0,0 +1,49 @@
+"""Compiled metadata index for the datasets.
+
+Parsing the attribute/label text files and checking that every image exists
+takes minutes on a cold NFS cache, and every rank, Test and Scores run used
+to pay it again. compiled_index stores the resulting filename table and label
+matrix as a single .npz next to the data, and rebuilds it only when one of
+the source files is modified.
+"""
+import os
+import numpy as np
+
+
+# ==================================================================#
+# ==================================================================#
+def compiled_index(index_file, sources, build, verbose=False):
+    """Return (filenames, labels) from index_file or from build().
+
+    Params:
+    -- index_file : .npz with the compiled index.
+    -- sources    : Files the index is built from. Their mtimes are stored in
+                    the index and a change in any of them triggers a rebuild.
+    -- build      : Function returning the lists (filenames, labels).
+    Returns:
+    -- filenames  : Numpy array of str, existence already resolved.
+    -- labels     : Numpy float32 array of dimension (n_images, n_labels).
+
+    Images added or removed without touching the sources are not detected,
+    remove index_file to force a rebuild.
+    """
+    mtimes = np.array([os.stat(source).st_mtime for source in sources])
+    if os.path.isfile(index_file):
+        index = np.load(index_file)
+        if np.array_equal(index['mtimes'], mtimes):
+            if verbose:
+                print('Metadata loaded from ' + index_file)
+            return index['filenames'], index['labels']
+
+    filenames, labels = build()
+    filenames = np.asarray(filenames, dtype=str)
+    labels = np.asarray(labels, dtype=np.float32)
+    tmp_file = '{}.{}.tmp'.format(index_file, os.getpid())
+    try:
+        # Atomic, all ranks may be building it at the same time
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, filenames=filenames, labels=labels, mtimes=mtimes)
+        os.rename(tmp_file, index_file)
+    except (IOError, OSError):
+        print('Metadata index could not be saved at ' + index_file)
+    return filenames, labels
@@ -42,6 +42,18 @@ def base_parser():
         '--sample_path', type=str, default='./snapshot/samples')
     parser.add_argument('--DEMO_PATH', type=str, default='')
     parser.add_argument('--DEMO_LABEL', type=str, default='')
+    # Packed split from misc/shards.py instead of one file per image
+    parser.add_argument('--shards', type=str, default='')
+    # Folder (local disk) to cache the resized images across epochs
+    parser.add_argument('--resize_cache', type=str, default='')
+    # Random crop, flip and normalization batched on the training device
+    parser.add_argument('--gpu_augment', action='store_true', default=False)
+    # Mixed precision (autocast and gradient scaling) for D and G updates
+    parser.add_argument('--amp', action='store_true', default=False)
+    # One generator pass over the whole batch for the D and the G steps
+    parser.add_argument('--fused_step', action='store_true', default=False)
+    # Micro-batches per D and G step, with gradient accumulation
+    parser.add_argument('--accum_steps', type=int, default=1)
 
     # Generative
     parser.add_argument('--MultiDis', type=int, default=3, choices=[1, 2, 3])
@@ -69,18 +81,27 @@ def base_parser():
     parser.add_argument('--LPIPS_UNIMODAL', action='store_true', default=False)
     parser.add_argument(
         '--LPIPS_MULTIMODAL', action='store_true', default=False)
+    # FID/KID per target domain, real statistics cached in scores/
+    parser.add_argument('--FID', action='store_true', default=False)
     parser.add_argument('--INCEPTION', action='store_true', default=False)
     parser.add_argument('--INCEPTION_REAL', action='store_true', default=False)
+    # Source images per batch for the LPIPS scores
+    parser.add_argument('--score_batch_size', type=int, default=1)
 
     # Step size
     parser.add_argument('--log_step', type=int, default=10)
     parser.add_argument('--sample_step', type=int, default=500)
     parser.add_argument('--model_save_step', type=int, default=10000)
+    # Mid-epoch checkpoint with the full training state every n iterations
+    parser.add_argument('--state_step', type=int, default=0)
 
     # Debug options
     parser.add_argument('--n_interpolation', type=int, default=5)
     parser.add_argument('--style_debug', type=int, default=4)
     parser.add_argument('--style_train_debug', type=int, default=9)
+    # Images per generator forward when translating all the domains at
+    # once in generate_SMIT, 0 runs one forward per domain
+    parser.add_argument('--inference_batch', type=int, default=0)
     parser.add_argument(
         '--style_label_debug', type=int, default=3, choices=[0, 1, 2, 3])
     config = parser.parse_args()
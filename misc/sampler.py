@@ -0,0 +1,75 @@
+"""Epoch-level shuffling over integer indices.
+
+EpochSampler replaces the per-epoch dataset.shuffle(epoch) in Train: the
+order of every epoch is a NumPy permutation seeded by (seed, epoch), padded
+and split across ranks like DistributedSampler, so it is deterministic per
+epoch and per rank. Its state (epoch and samples already seen by this rank)
+lets a restart continue mid-epoch without reading those samples again.
+
+ShardSampler splits an evaluation set into contiguous, unpadded shards, one
+per rank, so statistics summed over the ranks count every sample once.
+"""
+import math
+import numpy as np
+from torch.utils.data.sampler import Sampler
+
+
+# ==================================================================#
+# ==================================================================#
+class EpochSampler(Sampler):
+    def __init__(self, num_data, num_replicas=1, rank=0, seed=0):
+        self.num_data = num_data
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        self.start = 0
+        self.num_samples = int(
+            math.ceil(num_data / float(num_replicas)))
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def state_dict(self, start=0):
+        return {'epoch': self.epoch, 'start': start, 'seed': self.seed}
+
+    def load_state_dict(self, state):
+        self.epoch = state['epoch']
+        self.start = state['start']
+        self.seed = state.get('seed', self.seed)
+
+    def indices(self):
+        order = np.random.RandomState([self.seed, self.epoch]).permutation(
+            self.num_data)
+        # Evenly divisible across ranks
+        order = np.concatenate(
+            [order, order[:self.total_size - self.num_data]])
+        return order[self.rank:self.total_size:self.num_replicas]
+
+    def __iter__(self):
+        # The resume offset only applies to the next pass
+        indices = self.indices()[self.start:]
+        self.start = 0
+        return iter(indices.tolist())
+
+    def __len__(self):
+        return self.num_samples
+
+
+# ==================================================================#
+# ==================================================================#
+class ShardSampler(Sampler):
+    def __init__(self, num_data, num_replicas=1, rank=0):
+        self.num_data = num_data
+        self.num_replicas = num_replicas
+        self.rank = rank
+        # Samples [start, end) in order
+        self.start = num_data * rank // num_replicas
+        self.end = num_data * (rank + 1) // num_replicas
+
+    def __iter__(self):
+        return iter(range(self.start, self.end))
+
+    def __len__(self):
+        return self.end - self.start
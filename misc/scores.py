@@ -1,4 +1,4 @@
-from solver import Solver
+from solver import Solver, comm, hvd
 import torch
 import os
 import warnings
@@ -19,6 +19,38 @@ def FID(path, gpu=''):
     return fid_value
 
 
+def allreduce(stats):
+    # {key: value} summed over the ranks, value: a number, an array, a cpu
+    # tensor or a list of those
+    if hvd.size() == 1:
+        return stats
+    total = {}
+    for _stats in comm.allgather(stats):
+        for key, value in _stats.items():
+            if key not in total:
+                total[key] = value
+            elif isinstance(value, list):
+                total[key] = [a + b for a, b in zip(total[key], value)]
+            else:
+                total[key] = total[key] + value
+    return total
+
+
+def gather_statistics(statistics):
+    # {key: ActivationStatistics} merged over the ranks on rank 0, None on
+    # the other ranks
+    if hvd.size() == 1:
+        return statistics
+    gathered = comm.gather(statistics, root=0)
+    if hvd.rank() != 0:
+        return None
+    total = gathered[0]
+    for _statistics in gathered[1:]:
+        for key, stats in _statistics.items():
+            total[key].merge(stats)
+    return total
+
+
 def set_score(config):
     if config.LPIPS_REAL:
         scores = Scores(config)
@@ -35,6 +67,11 @@ def set_score(config):
         scores.LPIPS_MULTIMODAL()
         return True
 
+    if config.FID:
+        scores = Scores(config)
+        scores.FID()
+        return True
+
     if config.INCEPTION:
         scores = Scores(config)
         scores.INCEPTION()
@@ -47,6 +84,52 @@ def set_score(config):
     return False
 
 
+class InceptionStats(object):
+    """Inception scores exp(E[KL(p(y|x) || p(y))]) per key, from streaming
+    statistics. With S = sum_x p(y|x) over the n predictions of a prior
+    p(y) = S / |S|, the sum of the KL terms is
+        sum_x sum_y p log p - sum_y S log(S / |S|)"""
+
+    def __init__(self):
+        # key: [n, S, sum p log p] for a prior over everything added
+        self.stats = {}
+        # key: [n, sum of KL] for priors over groups already complete
+        self.groups = {}
+
+    def add(self, key, pred):
+        # pred (n, classes), sharing the prior of key
+        from scipy.special import xlogy
+        n, total, plogp = self.stats.get(key, (0, 0, 0))
+        self.stats[key] = [
+            n + pred.shape[0], total + pred.sum(0),
+            plogp + xlogy(pred, pred).sum()
+        ]
+
+    def add_groups(self, key, pred):
+        # pred (groups, n, classes), one prior for each group of n
+        from scipy.special import xlogy
+        total = pred.sum(1)
+        kl = xlogy(pred, pred).sum() - xlogy(
+            total, total / total.sum(1, keepdims=True)).sum()
+        n, _kl = self.groups.get(key, (0, 0))
+        self.groups[key] = [n + pred.shape[0] * pred.shape[1], _kl + kl]
+
+    def result(self, keys):
+        from scipy.special import xlogy
+        result = {}
+        for key in keys:
+            if key in self.stats:
+                n, total, plogp = self.stats[key]
+                kl = plogp - xlogy(total, total / total.sum()).sum()
+            elif key in self.groups:
+                n, kl = self.groups[key]
+            else:
+                result[key] = float('nan')
+                continue
+            result[key] = float(np.exp(kl / n))
+        return result
+
+
 class Scores(Solver):
     def __init__(self, config):
 
@@ -59,48 +142,85 @@ class Scores(Solver):
             config.mode,
             num_workers=config.num_workers,
             all_attr=config.ALL_ATTR,
-            c_dim=config.c_dim)
+            c_dim=config.c_dim,
+            shards=config.shards,
+            resize_cache=config.resize_cache)
+
+    def batch_loader(self, shard=False):
+        # Test split with --score_batch_size source images per batch, only
+        # the part of this rank if shard (Horovod)
+        shard = shard and hvd.size() > 1
+        if self.config.score_batch_size == 1 and not shard:
+            return self.data_loader
+        config = self.config
+        return get_loader(
+            config.mode_data,
+            config.image_size,
+            config.score_batch_size,
+            config.dataset_fake,
+            config.mode,
+            num_workers=config.num_workers,
+            all_attr=config.ALL_ATTR,
+            c_dim=config.c_dim,
+            HOROVOD=shard,
+            shards=config.shards,
+            resize_cache=config.resize_cache)
+
+    def reduce_pairs(self, DISTANCE):
+        # PairStats of every rank summed into DISTANCE
+        stats = {k: v.cpu() for k, v in DISTANCE.stats.items()}
+        DISTANCE.stats = allreduce(stats)
+        return DISTANCE
 
     def LPIPS(self):
-        from misc.utils import compute_lpips
+        # Distances are accumulated on the device, read once at the end
+        from misc.utils import get_torch_version, lpips_model
         data_loader = self.data_loader
         n_images = 100
         pair_styles = 20
-        model = None
-        DISTANCE = {0: [], 1: []}
+        model = lpips_model()
+        count = {0: 0, 1: 0}
         self.G.eval()
-        for i, (real_x, org_c, files) in tqdm(
-                enumerate(data_loader), desc='Calculating LPISP',
-                total=n_images):
-            for _real_x, _org_c in zip(real_x, org_c):
-                _real_x = _real_x.unsqueeze(0)
-                _org_c = _org_c.unsqueeze(0)
-                if len(DISTANCE[_org_c[0, 0]]) >= i:
-                    continue
-                _real_x = to_var(_real_x, volatile=True)
-                target_c = to_var(1 - _org_c, volatile=True)
-                for _ in range(pair_styles):
-                    style0 = to_var(
-                        self.G.random_style(_real_x.size(0)), volatile=True)
-                    style1 = to_var(
-                        self.G.random_style(_real_x.size(0)), volatile=True)
-                    fake_x0 = self.G(_real_x, target_c, stochastic=style0)
-                    fake_x1 = self.G(_real_x, target_c, stochastic=style1)
-                    distance, model = compute_lpips(
-                        fake_x0, fake_x1, model=model)
-                    DISTANCE[org_c[0, 0]].append(distance)
-                if i == len(DISTANCE[0, 0]) == len(DISTANCE[1]):
+        no_grad = open('/var/tmp/null.txt',
+                       'w') if get_torch_version() < 1.0 else torch.no_grad()
+        with no_grad:
+            for i, (real_x, org_c, files) in tqdm(
+                    enumerate(data_loader), desc='Calculating LPISP',
+                    total=n_images):
+                for _real_x, _org_c in zip(real_x, org_c):
+                    label = int(_org_c[0])
+                    if count[label] >= n_images:
+                        continue
+                    count[label] += 1
+                    _real_x = to_var(_real_x.unsqueeze(0), volatile=True)
+                    target_c = to_var(
+                        1 - _org_c.unsqueeze(0), volatile=True)
+                    for _ in range(pair_styles):
+                        style0 = to_var(
+                            self.G.random_style(_real_x.size(0)),
+                            volatile=True)
+                        style1 = to_var(
+                            self.G.random_style(_real_x.size(0)),
+                            volatile=True)
+                        fake_x0 = self.G(_real_x, target_c, style0)[0]
+                        fake_x1 = self.G(_real_x, target_c, style1)[0]
+                        model.accumulate(fake_x0, fake_x1, key=label)
+                if count[0] == count[1] == n_images:
                     break
-        print("LPISP a-b: {}".format(np.array(DISTANCE[0]).mean()))
-        print("LPISP b-a: {}".format(np.array(DISTANCE[1]).mean()))
+        DISTANCE = model.total()
+        print("LPISP a-b: {}".format(DISTANCE[0][0]))
+        print("LPISP b-a: {}".format(DISTANCE[1][0]))
 
     # ==================================================================#
     # ==================================================================#
 
     def LPIPS_REAL(self):
-        from misc.utils import compute_lpips
-        data_loader = self.data_loader
-        model = None
+        # LPIPS between real images, All: every pair i < j, per label: the
+        # pairs where j does not have that label
+        from misc.utils import lpips_model
+        from misc.lpips_engine import PairwiseLPIPS, PairStats
+        data_loader = self.batch_loader()
+        n_labels = len(data_loader.dataset.labels[0])
         file_name = 'scores/{}_Attr_{}_LPIPS.txt'.format(
             self.config.dataset_fake, self.config.ALL_ATTR)
         if os.path.isfile(file_name):
@@ -109,52 +229,128 @@ class Scores(Solver):
                 print(line.strip())
             return
 
-        DISTANCE = {
-            i: []
-            for i in range(len(data_loader.dataset.labels[0]) + 1)
-        }  # 0:[], 1:[], 2:[]}
-        for i, (real_x, org_c, files) in tqdm(
-                enumerate(data_loader),
-                desc='Calculating LPISP - {}'.format(file_name),
-                total=len(data_loader)):
-            for label in range(len(data_loader.dataset.labels[0])):
-                for j, (_real_x, _org_c, _files) in enumerate(data_loader):
-                    if j <= i:
-                        continue
-                    _org_label = torch.max(_org_c, 1)[1][0]
-                    for _label in range(len(data_loader.dataset.labels[0])):
-                        if _org_label == _label:
-                            continue
-                        distance, model = compute_lpips(
-                            real_x, _real_x, model=model)
-                        DISTANCE[len(data_loader.dataset.labels[0])].append(
-                            distance[0])
-                        if label == _label:
-                            DISTANCE[_label].append(distance[0])
+        # Features of every image, computed once on every rank, the pairs
+        # are split across ranks
+        labels = []
+
+        def batches():
+            for real_x, org_c, files in tqdm(
+                    data_loader,
+                    desc='LPISP features - {}'.format(file_name),
+                    total=len(data_loader)):
+                labels.append(torch.max(org_c, 1)[1])
+                yield real_x
+
+        engine = PairwiseLPIPS(lpips_model(), store_dir='scores')
+        engine.extract(batches(), len(data_loader.dataset))
+        labels = torch.cat(labels).to(engine.device)
+
+        DISTANCE = PairStats()
+        for rows, cols, distance in tqdm(
+                engine.blocks(hvd.rank(), hvd.size()),
+                desc='Calculating LPISP'):
+            mask = rows.view(-1, 1) < cols.view(1, -1)
+            DISTANCE.add(n_labels, distance, mask)
+            for label in range(n_labels):
+                DISTANCE.add(label, distance,
+                             mask & (labels[cols] != label).view(1, -1))
+        engine.close()
+        DISTANCE = self.reduce_pairs(DISTANCE)
+        if hvd.rank() == 0:
+            self.PRINT_LPIPS(file_name, DISTANCE.result(range(n_labels + 1)))
 
+    # ==================================================================#
+    # ==================================================================#
+    def PRINT_LPIPS(self, file_name, DISTANCE):
+        # DISTANCE: {label: (mean, std)}, the last key is All
         file_ = open(file_name, 'w')
-        DISTANCE = {k: np.array(v) for k, v in DISTANCE.items()}
-        for key, values in DISTANCE.items():
-            if key == len(data_loader.dataset.labels[0]):
+        for key, (mean, std) in sorted(DISTANCE.items()):
+            if key == len(DISTANCE) - 1:
                 mode = 'All'
             else:
                 mode = chr(65 + key)
-            PRINT(
-                file_, "LPISP {}: {} +/- {}".format(mode, values.mean(),
-                                                    values.std()))
+            PRINT(file_, "LPISP {}: {} +/- {}".format(mode, mean, std))
         file_.close()
 
     # ==================================================================#
     # ==================================================================#
 
+    def translate_all(self, store_name, style_fixed=True):
+        # Every image translated to every domain, uint8 (N, C, 3, H, W) in a
+        # memory-mapped .npy, reused if it already exists. The labels of the
+        # real images are stored next to it. Each rank translates and writes
+        # its own shard of the file, on a shared file system.
+        from misc.utils import get_torch_version
+        data_loader = self.batch_loader(shard=True)
+        n_labels = len(data_loader.dataset.labels[0])
+        label_name = store_name.replace('.npy', '_labels.npy')
+        if os.path.isfile(store_name) and os.path.isfile(label_name):
+            return np.load(store_name, mmap_mode='r'), np.load(label_name)
+
+        size = len(data_loader.dataset)
+        shape = (size, n_labels, self.config.color_dim,
+                 self.config.image_size, self.config.image_size)
+        tmp_name = store_name + '.tmp'
+        if hvd.rank() == 0:
+            fakes = np.lib.format.open_memmap(
+                tmp_name, mode='w+', dtype=np.uint8, shape=shape)
+            del fakes
+        comm.Barrier()
+        fakes = np.lib.format.open_memmap(tmp_name, mode='r+')
+        org_labels = np.zeros(size, dtype=np.int64)
+        style = to_var(self.G.random_style(1), volatile=True)
+        targets = to_var(torch.eye(n_labels), volatile=True)
+        index = getattr(data_loader.sampler, 'start', 0)
+        self.G.eval()
+        no_grad = open('/var/tmp/null.txt',
+                       'w') if get_torch_version() < 1.0 else torch.no_grad()
+        with no_grad:
+            for real_x, org_c, files in tqdm(
+                    data_loader,
+                    desc='Translating - {}'.format(store_name),
+                    total=len(data_loader)):
+                n = real_x.size(0)
+                real_x = to_var(real_x, volatile=True)
+                real_x = real_x.unsqueeze(1).expand(
+                    n, n_labels, *real_x.size()[1:]).contiguous().view(
+                        n * n_labels, *real_x.size()[1:])
+                target_c = targets.repeat(n, 1)
+                if style_fixed:
+                    _style = style.repeat(n * n_labels, 1)
+                else:
+                    _style = to_var(
+                        self.G.random_style(n * n_labels), volatile=True)
+                fake_x = self.G(real_x, target_c, _style)[0]
+                fake_x = ((fake_x + 1) * 127.5).round().clamp(0, 255)
+                fakes[index:index + n] = to_data(
+                    fake_x, cpu=True).byte().numpy().reshape(n, *shape[1:])
+                org_labels[index:index + n] = torch.max(org_c, 1)[1].numpy()
+                index += n
+        fakes.flush()
+        del fakes
+        # Zeros outside the shard of each rank
+        org_labels = allreduce({0: org_labels})[0]
+        comm.Barrier()
+        if hvd.rank() == 0:
+            np.save(label_name, org_labels)
+            os.rename(tmp_name, store_name)
+        comm.Barrier()
+        return np.load(store_name, mmap_mode='r'), org_labels
+
+    # ==================================================================#
+    # ==================================================================#
+
     def LPIPS_UNIMODAL(self):
-        from misc.utils import compute_lpips
+        # LPIPS between translations of different images i < j, All: every
+        # target domain of each, per label: both translated to that label
+        from misc.utils import lpips_model
+        from misc.lpips_engine import PairwiseLPIPS, PairStats
         from shutil import copyfile
         torch.manual_seed(1)
         torch.cuda.manual_seed(1)
 
         data_loader = self.data_loader
-        model = None
+        n_labels = len(data_loader.dataset.labels[0])
         style_fixed = True
         style_str = 'fixed' if style_fixed else 'random'
         file_name = os.path.join(
@@ -167,82 +363,62 @@ class Scores(Solver):
             for line in open(file_name).readlines():
                 print(line.strip())
             return
-
-        DISTANCE = {
-            i: []
-            for i in range(len(data_loader.dataset.labels[0]) + 1)
-        }  # 0:[], 1:[], 2:[]}
-        n_images = {i: 0 for i in range(len(data_loader.dataset.labels[0]))}
-
-        style0 = to_var(self.G.random_style(1), volatile=True)
         print(file_name)
-        for i, (real_x, org_c, files) in tqdm(
-                enumerate(data_loader),
-                desc='Calculating LPISP ',
-                total=len(data_loader)):
-            org_label = torch.max(org_c, 1)[1][0]
-            real_x = to_var(real_x, volatile=True)
-            for label in range(len(data_loader.dataset.labels[0])):
-                if org_label == label:
-                    continue
-                target_c = to_var(org_c * 0, volatile=True)
-                target_c[:, label] = 1
-                if not style_fixed:
-                    style0 = to_var(
-                        self.G.random_style(real_x.size(0)), volatile=True)
-                real_x = self.G(
-                    real_x, to_var(target_c, volatile=True),
-                    stochastic=style0)[0]
-                n_images[label] += 1
-                for j, (_real_x, _org_c, _files) in enumerate(data_loader):
-                    if j <= i:
-                        continue
-                    _org_label = torch.max(_org_c, 1)[1][0]
-                    _real_x = to_var(_real_x, volatile=True)
-                    for _label in range(len(data_loader.dataset.labels[0])):
-                        if _org_label == _label:
-                            continue
-                        _target_c = to_var(_org_c * 0, volatile=True)
-                        _target_c[:, _label] = 1
-                        if not style_fixed:
-                            style0 = to_var(
-                                self.G.random_style(_real_x.size(0)),
-                                volatile=True)
-                        _real_x = self.G(
-                            _real_x,
-                            to_var(_target_c, volatile=True),
-                            stochastic=style0)[0]
-                        distance, model = compute_lpips(
-                            real_x.data, _real_x.data, model=model)
-                        DISTANCE[len(data_loader.dataset.labels[0])].append(
-                            distance[0])
-                        if label == _label:
-                            DISTANCE[_label].append(distance[0])
 
-        file_ = open(file_name, 'w')
-        DISTANCE = {k: np.array(v) for k, v in DISTANCE.items()}
-        for key, values in DISTANCE.items():
-            if key == len(data_loader.dataset.labels[0]):
-                mode = 'All'
-            else:
-                mode = chr(65 + key)
-            PRINT(
-                file_, "LPISP {}: {} +/- {}".format(mode, values.mean(),
-                                                    values.std()))
-        file_.close()
-        copyfile(file_name, copy_name)
+        # Phase one: translations computed once
+        store_name = self.name.replace(
+            '{}.pth', 'LPIPS_UNIMODAL_{}.npy'.format(style_str))
+        fakes, org_labels = self.translate_all(store_name, style_fixed)
+
+        # Phase two: pairwise LPIPS over the stored translations, except the
+        # ones to the domain of the real image
+        items = np.array([(i, label) for i in range(len(org_labels))
+                          for label in range(n_labels)
+                          if label != org_labels[i]]).reshape(-1, 2)
+        engine = PairwiseLPIPS(lpips_model(), store_dir='scores')
+
+        def batches():
+            for k in tqdm(
+                    range(0, len(items), engine.tile),
+                    desc='LPISP features - {}'.format(file_name)):
+                index = items[k:k + engine.tile]
+                fake_x = torch.from_numpy(fakes[index[:, 0], index[:, 1]])
+                yield fake_x.float() / 127.5 - 1
+
+        engine.extract(batches(), len(items))
+        images = torch.from_numpy(items[:, 0]).to(engine.device)
+        labels = torch.from_numpy(items[:, 1]).to(engine.device)
+
+        DISTANCE = PairStats()
+        for rows, cols, distance in tqdm(
+                engine.blocks(hvd.rank(), hvd.size()),
+                desc='Calculating LPISP'):
+            mask = images[rows].view(-1, 1) < images[cols].view(1, -1)
+            DISTANCE.add(n_labels, distance, mask)
+            same = labels[rows].view(-1, 1) == labels[cols].view(1, -1)
+            for label in range(n_labels):
+                DISTANCE.add(label, distance,
+                             mask & same & (labels[cols] == label).view(1, -1))
+        engine.close()
+        DISTANCE = self.reduce_pairs(DISTANCE)
+        if hvd.rank() == 0:
+            self.PRINT_LPIPS(file_name, DISTANCE.result(range(n_labels + 1)))
+            copyfile(file_name, copy_name)
 
     # ==================================================================#
     # ==================================================================#
 
     def LPIPS_MULTIMODAL(self):
-        from misc.utils import compute_lpips
+        # Mean LPIPS between n_images styles of the same image and target
+        # domain, All: every image and domain, per label: that domain
+        from misc.utils import get_torch_version, lpips_model
+        from misc.lpips_engine import PairwiseLPIPS, PairStats
 
         torch.manual_seed(1)
         torch.cuda.manual_seed(1)
 
-        data_loader = self.data_loader
-        model = None
+        data_loader = self.batch_loader(shard=True)
+        n_labels = len(data_loader.dataset.labels[0])
         n_images = 20
 
         file_name = os.path.join(
@@ -252,60 +428,158 @@ class Scores(Solver):
             for line in open(file_name).readlines():
                 print(line.strip())
 
-        # DISTANCE = {0:[], 1:[], 2:[]}
-        DISTANCE = {
-            i: []
-            for i in range(len(data_loader.dataset.labels[0]) + 1)
-        }  # 0:[], 1:[], 2:[]}
+        engine = PairwiseLPIPS(lpips_model())
+        DISTANCE = PairStats()
+        targets = torch.eye(n_labels)
         print(file_name)
-        for i, (real_x, org_c, files) in tqdm(
-                enumerate(data_loader),
-                desc='Calculating LPISP ',
-                total=len(data_loader)):
-            org_label = torch.max(org_c, 1)[1][0]
-            for label in range(len(data_loader.dataset.labels[0])):
-                if org_label == label:
-                    continue
-                target_c = org_c * 0
-                target_c[:, label] = 1
-                target_c = target_c.repeat(n_images, 1)
-                real_x_var = to_var(
-                    real_x.repeat(n_images, 1, 1, 1), volatile=True)
-                target_c = to_var(target_c, volatile=True)
-                style = to_var(self.G.random_style(n_images), volatile=True)
-                fake_x = self.G(real_x_var, target_c, stochastic=style)[0].data
-                fake_x = [f.unsqueeze(0) for f in fake_x]
-                _DISTANCE = []
-                for ii, fake0 in enumerate(fake_x):
-                    for jj, fake1 in enumerate(fake_x):
-                        if jj <= ii:
-                            continue
-                        distance, model = compute_lpips(
-                            fake0, fake1, model=model)
-                        _DISTANCE.append(distance[0])
-                DISTANCE[len(data_loader.dataset.labels[0])].append(
-                    np.array(_DISTANCE).mean())
-                DISTANCE[label].append(DISTANCE[len(
-                    data_loader.dataset.labels[0])][-1])
+        no_grad = open('/var/tmp/null.txt',
+                       'w') if get_torch_version() < 1.0 else torch.no_grad()
+        with no_grad:
+            for i, (real_x, org_c, files) in tqdm(
+                    enumerate(data_loader),
+                    desc='Calculating LPISP ',
+                    total=len(data_loader)):
+                org_label = torch.max(org_c, 1)[1]
+                for label in range(n_labels):
+                    keep = (org_label != label).nonzero().view(-1)
+                    if keep.numel() == 0:
+                        continue
+                    # n_images styles for each source image, one batch
+                    _real_x = real_x[keep]
+                    n = _real_x.size(0)
+                    _real_x = _real_x.unsqueeze(1).expand(
+                        n, n_images, *_real_x.size()[1:]).contiguous()
+                    _real_x = to_var(
+                        _real_x.view(n * n_images, *_real_x.size()[2:]),
+                        volatile=True)
+                    target_c = to_var(
+                        targets[label].repeat(n * n_images, 1),
+                        volatile=True)
+                    style = to_var(
+                        self.G.random_style(n * n_images), volatile=True)
+                    fake_x = self.G(_real_x, target_c, style)[0]
+                    distance = engine.diversity(
+                        fake_x.view(n, n_images, *fake_x.size()[1:]))
+                    DISTANCE.add(n_labels, distance)
+                    DISTANCE.add(label, distance)
+
+        DISTANCE = self.reduce_pairs(DISTANCE)
+        if hvd.rank() == 0:
+            self.PRINT_LPIPS(file_name, DISTANCE.result(range(n_labels + 1)))
 
+    # ==================================================================#
+    # ==================================================================#
+
+    def FID(self, dims=2048):
+        # FID and KID between the translations to each domain and the real
+        # images of that domain, straight from G. The statistics of the real
+        # images are cached per dataset, split, image size and dims.
+        from misc.fid_score import (InceptionV3, ActivationStatistics,
+                                    statistics_path, load_statistics,
+                                    load_references, save_statistics)
+        torch.manual_seed(1)
+        torch.cuda.manual_seed(1)
+
+        data_loader = self.batch_loader(shard=True)
+        n_labels = len(data_loader.dataset.labels[0])
+        file_name = os.path.join(self.name.replace('{}.pth', 'FID.txt'))
+        if os.path.isfile(file_name):
+            print(file_name)
+            for line in open(file_name).readlines():
+                print(line.strip())
+            return
+        print(file_name)
+
+        cuda = torch.cuda.is_available()
+        model = InceptionV3([InceptionV3.BLOCK_INDEX_BY_DIM[dims]])
+        model = to_cuda(model) if cuda else model
+        model.eval()
+
+        dataset = '{}_Attr_{}'.format(self.config.dataset_fake,
+                                      self.config.ALL_ATTR)
+        ref_name = statistics_path(dataset, self.config.mode,
+                                   self.config.image_size, dims)
+        REAL = None
+        if not os.path.isfile(ref_name):
+            REAL = {i: ActivationStatistics(dims) for i in range(n_labels)}
+        FAKE = {i: ActivationStatistics(dims) for i in range(n_labels)}
+        self.fid_activations(data_loader, model, cuda, FAKE, REAL)
+        FAKE = gather_statistics(FAKE)
+        if REAL is not None:
+            REAL = gather_statistics(REAL)
+        if hvd.rank() != 0:
+            return
+        if REAL is not None:
+            save_statistics(ref_name, REAL)
+        self.PRINT_FID(file_name, load_statistics(ref_name),
+                       load_references(ref_name), FAKE)
+
+    def fid_activations(self, data_loader, model, cuda, FAKE, REAL=None):
+        # Inception activations of the translations of every image to every
+        # other domain, and of the real images if REAL is given
+        from misc.utils import get_torch_version
+        from misc.fid_score import get_batch_activations
+        n_labels = len(FAKE)
+        targets = torch.eye(n_labels)
+        self.G.eval()
+        no_grad = open('/var/tmp/null.txt',
+                       'w') if get_torch_version() < 1.0 else torch.no_grad()
+        with no_grad:
+            for real_x, org_c, files in tqdm(
+                    data_loader,
+                    desc='Calculating FID/KID',
+                    total=len(data_loader)):
+                org_label = torch.max(org_c, 1)[1]
+                if REAL is not None:
+                    act = get_batch_activations((real_x + 1) / 2, model, cuda)
+                    for label in range(n_labels):
+                        REAL[label].update(act[(org_label == label).numpy()])
+                for label in range(n_labels):
+                    keep = (org_label != label).nonzero().view(-1)
+                    if keep.numel() == 0:
+                        continue
+                    _real_x = to_var(real_x[keep], volatile=True)
+                    target_c = to_var(
+                        targets[label].repeat(keep.numel(), 1),
+                        volatile=True)
+                    style = to_var(
+                        self.G.random_style(keep.numel()), volatile=True)
+                    fake_x = self.G(_real_x, target_c, style)[0]
+                    FAKE[label].update(
+                        get_batch_activations((fake_x + 1) / 2, model, cuda))
+
+    def PRINT_FID(self, file_name, REAL, REFERENCES, FAKE):
+        # REAL: {label: (mu, sigma, act)}, REFERENCES: {label:
+        # FrechetReference} of REAL, FAKE: {label: ActivationStatistics}
+        from misc.fid_score import calculate_kid
         file_ = open(file_name, 'w')
-        DISTANCE = {k: np.array(v) for k, v in DISTANCE.items()}
-        for key, values in DISTANCE.items():
-            if key == len(data_loader.dataset.labels[0]):
-                mode = 'All'
-            else:
-                mode = chr(65 + key)
-            PRINT(
-                file_, "LPISP {}: {} +/- {}".format(mode, values.mean(),
-                                                    values.std()))
+        total_fid = []
+        total_kid = []
+        for label in sorted(FAKE.keys()):
+            fake = FAKE[label]
+            if label not in REAL or fake.n < 2:
+                continue
+            act = REAL[label][2]
+            fid = float(REFERENCES[label](fake.mu, fake.sigma))
+            kid, kid_std = calculate_kid(fake.act, act)
+            total_fid.append(fid)
+            total_kid.append(kid)
+            PRINT(file_, "FID {}: {}".format(chr(65 + label), fid))
+            PRINT(file_, "KID {}: {} +/- {}".format(
+                chr(65 + label), kid, kid_std))
+        PRINT(file_, "FID All: {} +/- {}".format(
+            np.mean(total_fid), np.std(total_fid)))
+        PRINT(file_, "KID All: {} +/- {}".format(
+            np.mean(total_kid), np.std(total_kid)))
         file_.close()
 
     # ==================================================================#
     # ==================================================================#
 
     def INCEPTION(self):
-        from misc.utils import load_inception
-        from scipy.stats import entropy
+        # IS and CIS of n_styles translations of every image to every other
+        # domain, from streaming statistics per domain (InceptionStats)
+        from misc.utils import get_torch_version, load_inception
         n_styles = 20
         net = load_inception()
         net = to_cuda(net)
@@ -313,128 +587,109 @@ class Scores(Solver):
         self.G.eval()
         inception_up = nn.Upsample(size=(299, 299), mode='bilinear')
         mode = 'SMIT'
-        data_loader = self.data_loader
+        data_loader = self.batch_loader(shard=True)
+        n_labels = len(data_loader.dataset.labels[0])
         file_name = 'scores/Inception_{}.txt'.format(mode)
 
-        PRED_IS = {i: []
-                   for i in range(len(data_loader.dataset.labels[0]))
-                   }  # 0:[], 1:[], 2:[]}
-        CIS = {i: [] for i in range(len(data_loader.dataset.labels[0]))}
-        IS = {i: [] for i in range(len(data_loader.dataset.labels[0]))}
-
-        for i, (real_x, org_c, files) in tqdm(
-                enumerate(data_loader),
-                desc='Calculating CIS/IS - {}'.format(file_name),
-                total=len(data_loader)):
-            PRED_CIS = {
-                i: []
-                for i in range(len(data_loader.dataset.labels[0]))
-            }  # 0:[], 1:[], 2:[]}
-            org_label = torch.max(org_c, 1)[1][0]
-            real_x = real_x.repeat(n_styles, 1, 1, 1)  # .unsqueeze(0)
-            real_x = to_var(real_x, volatile=True)
-
-            target_c = (org_c * 0).repeat(n_styles, 1)
-            target_c = to_var(target_c, volatile=True)
-            for label in range(len(data_loader.dataset.labels[0])):
-                if org_label == label:
-                    continue
-                target_c *= 0
-                target_c[:, label] = 1
-                style = to_var(
-                    self.G.random_style(n_styles),
-                    volatile=True) if mode == 'SMIT' else None
-
-                fake = (self.G(real_x, target_c, style)[0] + 1) / 2
-
-                pred = to_data(
-                    F.softmax(net(inception_up(fake)), dim=1),
-                    cpu=True).numpy()
-                PRED_CIS[label].append(pred)
-                PRED_IS[label].append(pred)
-
-                # CIS for each image
-                PRED_CIS[label] = np.concatenate(PRED_CIS[label], 0)
-                py = np.sum(
-                    PRED_CIS[label], axis=0
-                )  # prior is computed from outputs given a specific input
-                for j in range(PRED_CIS[label].shape[0]):
-                    pyx = PRED_CIS[label][j, :]
-                    CIS[label].append(entropy(pyx, py))
-
-        for label in range(len(data_loader.dataset.labels[0])):
-            PRED_IS[label] = np.concatenate(PRED_IS[label], 0)
-            py = np.sum(
-                PRED_IS[label], axis=0)  # prior is computed from all outputs
-            for j in range(PRED_IS[label].shape[0]):
-                pyx = PRED_IS[label][j, :]
-                IS[label].append(entropy(pyx, py))
-
-        total_cis = []
-        total_is = []
-        file_ = open(file_name, 'w')
-        for label in range(len(data_loader.dataset.labels[0])):
-            cis = np.exp(np.mean(CIS[label]))
-            total_cis.append(cis)
-            _is = np.exp(np.mean(IS[label]))
-            total_is.append(_is)
-            PRINT(file_, "Label {}".format(label))
-            PRINT(file_, "Inception Score: {:.4f}".format(_is))
-            PRINT(file_, "conditional Inception Score: {:.4f}".format(cis))
-        PRINT(file_, "")
-        PRINT(
-            file_, "[TOTAL] Inception Score: {:.4f} +/- {:.4f}".format(
-                np.array(total_is).mean(),
-                np.array(total_is).std()))
-        PRINT(
-            file_,
-            "[TOTAL] conditional Inception Score: {:.4f} +/- {:.4f}".format(
-                np.array(total_cis).mean(),
-                np.array(total_cis).std()))
-        file_.close()
+        # IS: prior p(y) from all the outputs of a domain
+        IS = InceptionStats()
+        # CIS: prior p(y) from the outputs given a specific input
+        CIS = InceptionStats()
+        targets = torch.eye(n_labels)
+        no_grad = open('/var/tmp/null.txt',
+                       'w') if get_torch_version() < 1.0 else torch.no_grad()
+        with no_grad:
+            for real_x, org_c, files in tqdm(
+                    data_loader,
+                    desc='Calculating CIS/IS - {}'.format(file_name),
+                    total=len(data_loader)):
+                org_label = torch.max(org_c, 1)[1]
+                for label in range(n_labels):
+                    keep = (org_label != label).nonzero().view(-1)
+                    if keep.numel() == 0:
+                        continue
+                    # n_styles styles for each source image, one batch
+                    _real_x = real_x[keep]
+                    n = _real_x.size(0)
+                    _real_x = _real_x.unsqueeze(1).expand(
+                        n, n_styles, *_real_x.size()[1:]).contiguous()
+                    _real_x = to_var(
+                        _real_x.view(n * n_styles, *_real_x.size()[2:]),
+                        volatile=True)
+                    target_c = to_var(
+                        targets[label].repeat(n * n_styles, 1),
+                        volatile=True)
+                    style = to_var(
+                        self.G.random_style(n * n_styles),
+                        volatile=True) if mode == 'SMIT' else None
+
+                    fake = (self.G(_real_x, target_c, style)[0] + 1) / 2
+
+                    pred = to_data(
+                        F.softmax(net(inception_up(fake)), dim=1),
+                        cpu=True).numpy().astype(np.float64)
+                    IS.add(label, pred)
+                    CIS.add_groups(label, pred.reshape(n, n_styles, -1))
+
+        IS.stats = allreduce(IS.stats)
+        CIS.groups = allreduce(CIS.groups)
+        if hvd.rank() == 0:
+            self.PRINT_INCEPTION(file_name, IS.result(range(n_labels)),
+                                 CIS.result(range(n_labels)))
 
     def INCEPTION_REAL(self):
-        from misc.utils import load_inception
-        from scipy.stats import entropy
+        from misc.utils import get_torch_version, load_inception
         net = load_inception()
         net = to_cuda(net)
         net.eval()
         inception_up = nn.Upsample(size=(299, 299), mode='bilinear')
         mode = 'Real'
-        data_loader = self.data_loader
+        data_loader = self.batch_loader(shard=True)
+        n_labels = len(data_loader.dataset.labels[0])
         file_name = 'scores/Inception_{}.txt'.format(mode)
 
-        PRED_IS = {i: [] for i in range(len(data_loader.dataset.labels[0]))}
-        IS = {i: [] for i in range(len(data_loader.dataset.labels[0]))}
-
-        for i, (real_x, org_c, files) in tqdm(
-                enumerate(data_loader),
-                desc='Calculating CIS/IS - {}'.format(file_name),
-                total=len(data_loader)):
-            label = torch.max(org_c, 1)[1][0]
-            real_x = to_var((real_x + 1) / 2., volatile=True)
-            pred = to_data(
-                F.softmax(net(inception_up(real_x)), dim=1), cpu=True).numpy()
-            PRED_IS[int(label)].append(pred)
-
-        for label in range(len(data_loader.dataset.labels[0])):
-            PRED_IS[label] = np.concatenate(PRED_IS[label], 0)
-            # prior is computed from all outputs
-            py = np.sum(PRED_IS[label], axis=0)
-            for j in range(PRED_IS[label].shape[0]):
-                pyx = PRED_IS[label][j, :]
-                IS[label].append(entropy(pyx, py))
+        IS = InceptionStats()
+        no_grad = open('/var/tmp/null.txt',
+                       'w') if get_torch_version() < 1.0 else torch.no_grad()
+        with no_grad:
+            for real_x, org_c, files in tqdm(
+                    data_loader,
+                    desc='Calculating CIS/IS - {}'.format(file_name),
+                    total=len(data_loader)):
+                org_label = torch.max(org_c, 1)[1].numpy()
+                real_x = to_var((real_x + 1) / 2., volatile=True)
+                pred = to_data(
+                    F.softmax(net(inception_up(real_x)), dim=1),
+                    cpu=True).numpy().astype(np.float64)
+                for label in np.unique(org_label):
+                    IS.add(int(label), pred[org_label == label])
+
+        IS.stats = allreduce(IS.stats)
+        if hvd.rank() == 0:
+            self.PRINT_INCEPTION(file_name, IS.result(range(n_labels)))
 
+    def PRINT_INCEPTION(self, file_name, IS, CIS=None):
+        # IS, CIS: {label: score}
+        total_cis = []
         total_is = []
         file_ = open(file_name, 'w')
-        for label in range(len(data_loader.dataset.labels[0])):
-            _is = np.exp(np.mean(IS[label]))
-            total_is.append(_is)
+        for label in sorted(IS.keys()):
+            total_is.append(IS[label])
             PRINT(file_, "Label {}".format(label))
-            PRINT(file_, "Inception Score: {:.4f}".format(_is))
+            PRINT(file_, "Inception Score: {:.4f}".format(IS[label]))
+            if CIS is not None:
+                total_cis.append(CIS[label])
+                PRINT(file_, "conditional Inception Score: {:.4f}".format(
+                    CIS[label]))
         PRINT(file_, "")
         PRINT(
             file_, "[TOTAL] Inception Score: {:.4f} +/- {:.4f}".format(
                 np.array(total_is).mean(),
                 np.array(total_is).std()))
+        if CIS is not None:
+            PRINT(
+                file_,
+                "[TOTAL] conditional Inception Score: {:.4f} +/- {:.4f}".
+                format(np.array(total_cis).mean(),
+                       np.array(total_cis).std()))
         file_.close()
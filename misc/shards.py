@@ -0,0 +1,217 @@
+"""Packed, memory-mapped image shards.
+
+A dataset split is packed offline into a few large shard files holding the
+encoded images back to back. An index keeps the byte range of every record
+and the label matrix is stored as a packed array next to it, so opening the
+split is a couple of array loads and reading a sample is a slice of a
+memory-mapped shard instead of a random small-file read.
+
+Packing (uses the same options as main.py):
+    python -m misc.shards --dataset_fake=CelebA --mode=train
+Training from the shards:
+    ./main.py --dataset_fake=CelebA --shards=data/CelebA/shards/normal_train_0
+"""
+import io
+import os
+import mmap
+import importlib
+import numpy as np
+import torch
+from PIL import Image
+from torch.utils.data import Dataset
+
+INDEX = 'index.npz'
+LABELS = 'labels.npy'
+SHARD = 'shard_{}.bin'
+
+
+# ==================================================================#
+# ==================================================================#
+class RecordReader(io.RawIOBase):
+    """Read-only file over a memoryview of a shard record, PIL reads the
+    encoded image from the mapping without an intermediate bytes copy."""
+
+    def __init__(self, view):
+        super(RecordReader, self).__init__()
+        self.view = view
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        size = max(0, min(len(buffer), len(self.view) - self.pos))
+        buffer[:size] = self.view[self.pos:self.pos + size]
+        self.pos += size
+        return size
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self.pos
+        elif whence == io.SEEK_END:
+            offset += len(self.view)
+        if offset < 0:
+            raise ValueError('Negative seek position {}'.format(offset))
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+
+# ==================================================================#
+# ==================================================================#
+def shard_dir(dataset, mode, mode_data, all_attr=0, root='data'):
+    return os.path.join(root, dataset, 'shards', '{}_{}_{}'.format(
+        mode_data, mode, all_attr))
+
+
+# ==================================================================#
+# ==================================================================#
+def pack(dataset, output_dir, shard_size=1 << 30, verbose=True):
+    """Pack filenames and labels of a dataset into shards at output_dir."""
+    from tqdm import tqdm
+    filenames, labels = dataset.get_data()
+    if not os.path.isdir(output_dir):
+        os.makedirs(output_dir)
+
+    shard = np.zeros(len(filenames), dtype=np.int32)
+    offset = np.zeros(len(filenames), dtype=np.int64)
+    length = np.zeros(len(filenames), dtype=np.int64)
+    n_shard = 0
+    f_shard = open(os.path.join(output_dir, SHARD.format(n_shard)), 'wb')
+    for idx, filename in tqdm(
+            enumerate(filenames),
+            total=len(filenames),
+            desc='Packing {}'.format(output_dir),
+            disable=not verbose):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if f_shard.tell() and f_shard.tell() + len(data) > shard_size:
+            f_shard.close()
+            n_shard += 1
+            f_shard = open(
+                os.path.join(output_dir, SHARD.format(n_shard)), 'wb')
+        shard[idx] = n_shard
+        offset[idx] = f_shard.tell()
+        length[idx] = len(data)
+        f_shard.write(data)
+    f_shard.close()
+
+    np.save(
+        os.path.join(output_dir, LABELS), np.asarray(
+            labels, dtype=np.float32))
+    np.savez(
+        os.path.join(output_dir, INDEX),
+        shard=shard,
+        offset=offset,
+        length=length,
+        filenames=np.asarray(filenames),
+        selected_attrs=np.asarray(getattr(dataset, 'selected_attrs', [])),
+        name=np.asarray(getattr(dataset, 'name', '')))
+    if verbose:
+        print('Packed {} images into {} shards at {}'.format(
+            len(filenames), n_shard + 1, output_dir))
+
+
+# ==================================================================#
+# == Shards
+# ==================================================================#
+class ShardDataset(Dataset):
+    def __init__(self,
+                 image_size,
+                 path,
+                 transform,
+                 mode,
+                 shuffling=False,
+                 verbose=False,
+                 **kwargs):
+        self.image_size = image_size
+        self.path = path
+        self.transform = transform
+        self.mode = mode
+        self.shuffling = shuffling
+        self.verbose = verbose
+        index = np.load(os.path.join(path, INDEX))
+        self.shard = index['shard']
+        self.offset = index['offset']
+        self.length = index['length']
+        self.filenames = index['filenames']
+        self.name = str(index['name'])
+        self.selected_attrs = index['selected_attrs'].tolist()
+        self.attr2idx = {
+            attr: idx
+            for idx, attr in enumerate(self.selected_attrs)
+        }
+        self.idx2attr = {
+            idx: attr
+            for idx, attr in enumerate(self.selected_attrs)
+        }
+        self.labels = np.load(os.path.join(path, LABELS), mmap_mode='r')
+        self.num_data = len(self.filenames)
+        # Shards are mapped lazily, once per (worker) process
+        self._shards = {}
+        if self.verbose:
+            print('Loaded %s shards from %s (%d)!' % (self.name, path,
+                                                      self.num_data))
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_shards'] = {}
+        return state
+
+    def get_shard(self, idx):
+        if idx not in self._shards:
+            with open(os.path.join(self.path, SHARD.format(idx)), 'rb') as f:
+                self._shards[idx] = mmap.mmap(
+                    f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._shards[idx]
+
+    def get_data(self):
+        return self.filenames, self.labels
+
+    def __getitem__(self, index):
+        start = self.offset[index]
+        data = self.get_shard(self.shard[index])
+        data = memoryview(data)[start:start + self.length[index]]
+        image = Image.open(RecordReader(data)).convert('RGB')
+        label = np.array(self.labels[index])
+        return self.transform(image), torch.FloatTensor(
+            label), self.filenames[index]
+
+    def __len__(self):
+        return self.num_data
+
+    def shuffle(self, seed):
+        order = np.random.RandomState(seed).permutation(self.num_data)
+        self.shard = self.shard[order]
+        self.offset = self.offset[order]
+        self.length = self.length[order]
+        self.filenames = self.filenames[order]
+        self.labels = self.labels[order]
+
+
+if __name__ == '__main__':
+    # python -m misc.shards --dataset_fake=CelebA --mode=train
+    from misc.options import base_parser
+    from misc.utils import config_yaml
+    config = base_parser()
+    config_yaml(config, 'datasets/{}.yaml'.format(config.dataset_fake))
+    name = config.dataset_fake.split('/')[0]
+    dataset_module = getattr(
+        importlib.import_module('datasets.{}'.format(name)), name)
+    dataset = dataset_module(
+        config.image_size,
+        config.mode_data,
+        None,
+        config.mode,
+        shuffling=config.mode == 'train',
+        all_attr=config.ALL_ATTR,
+        c_dim=config.c_dim,
+        verbose=True)
+    output_dir = config.shards or shard_dir(name, config.mode,
+                                            config.mode_data, config.ALL_ATTR)
+    pack(dataset, output_dir)
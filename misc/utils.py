@@ -44,15 +44,27 @@ def color(dict, key, color='red'):
 
 # ==================================================================#
 # ==================================================================#
-def compute_lpips(img0, img1, model=None):
+def lpips_model():
+    import torch
+    from misc.lpips_model import DistModel
+    model = DistModel()
+    version = '0.0'  # Totally different values with 0.1
+    model.initialize(
+        model='net-lin',
+        net='alex',
+        use_gpu=torch.cuda.is_available(),
+        version=version)
+    return model
+
+
+# ==================================================================#
+# ==================================================================#
+def compute_lpips(img0, img1, model=None, retNumpy=True):
     # RGB image from must be [-1,1]
+    # retNumpy=False keeps the distance on the device
     if model is None:
-        from misc.lpips_model import DistModel
-        model = DistModel()
-        version = '0.0'  # Totally different values with 0.1
-        model.initialize(
-            model='net-lin', net='alex', use_gpu=True, version=version)
-    dist = model.forward(img0, img1)
+        model = lpips_model()
+    dist = model.forward(img0, img1, retNumpy=retNumpy)
     return dist, model
 
 
@@ -292,6 +304,33 @@ def get_torch_version():
     return float('.'.join(torch.__version__.split('.')[:2]))
 
 
+# ==================================================================#
+# ==================================================================#
+def autocast(enabled=True):
+    # Mixed precision region for --amp. It is also used with enabled=False
+    # to force fp32 inside an autocast region.
+    import torch
+    if hasattr(torch, 'autocast'):
+        return torch.autocast('cuda', enabled=enabled)
+    elif hasattr(torch.cuda, 'amp'):
+        return torch.cuda.amp.autocast(enabled=enabled)
+    return open('/var/tmp/null.txt', 'w')
+
+
+# ==================================================================#
+# ==================================================================#
+def grad_scaler(enabled=True):
+    # None when fp16 is not available, the step is then a plain fp32 step
+    import torch
+    if not enabled or not torch.cuda.is_available():
+        return None
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda')
+    elif hasattr(torch.cuda, 'amp'):
+        return torch.cuda.amp.GradScaler()
+    return None
+
+
 # ==================================================================#
 # ==================================================================#
 def horovod():
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 from misc.utils import to_var
+from misc.blocks import AdaptiveInstanceNorm2d
 from models.domain_embedding import DE
 from models.generator import Generator
 
@@ -20,7 +21,17 @@ class AdaInGEN(nn.Module):
         self.generator = Generator(config, debug=False)
         in_dim = self.style_dim + self.c_dim
 
-        de_params = self.get_num_de_params(self.generator)
+        # AdaIN layers and the size of their slices of the DE output
+        # [mean_0, std_0, mean_1, std_1, ...], computed once. A ModuleList
+        # so nn.DataParallel replicas bind their own layers.
+        self.adain_layers = nn.ModuleList([
+            m for m in self.generator.modules()
+            if isinstance(m, AdaptiveInstanceNorm2d)
+        ])
+        self.de_split = []
+        for m in self.adain_layers:
+            self.de_split += [m.num_features, m.num_features]
+        de_params = self.get_num_de_params()
         self.Domain_Embedding = DE(
             config, in_dim, de_params, train=False, debug=debug)
         if debug:
@@ -37,8 +48,10 @@ class AdaInGEN(nn.Module):
         self.generator.debug()
 
     def forward(self, image, domain, style, DE=None):
-        self.apply_style(image, domain, style, DE=DE)
-        return self.generator(image)
+        # The AdaIN parameters go through the call, nothing is assigned to
+        # the modules, so one model can serve concurrent translations
+        de_params = self.get_de_params(domain, style, DE=DE)
+        return self.generator(image, self.split_de_params(de_params))
 
     def random_style(self, x, seed=None):
         if isinstance(x, int):
@@ -56,29 +69,31 @@ class AdaInGEN(nn.Module):
         input_de = torch.cat([style, label], dim=-1)
         return input_de
 
-    def apply_style(self, image, label, style, DE=None):
+    def get_de_params(self, label, style, DE=None):
         if DE is None:
             input_de = self.preprocess(label, style)
-            de_params = self.Domain_Embedding(input_de)
-        else:
-            de_params = DE
-        self.assign_de_params(de_params, self.generator)
+            return self.Domain_Embedding(input_de)
+        return DE
+
+    def apply_style(self, image, label, style, DE=None):
+        # Binds the parameters to the AdaIN layers, for code running the
+        # generator layers one by one (debug)
+        de_params = self.get_de_params(label, style, DE=DE)
+        self.assign_de_params(de_params)
+
+    def split_de_params(self, de_params):
+        # (weight, bias) for each AdaIN layer, with a single split
+        de_params = torch.split(de_params, self.de_split, dim=1)
+        return [(std.reshape(-1), mean.reshape(-1))
+                for mean, std in zip(de_params[0::2], de_params[1::2])]
 
-    def assign_de_params(self, de_params, model):
-        # assign the de_params to the AdaIN layers in model
-        for m in model.modules():
-            if m.__class__.__name__ == "AdaptiveInstanceNorm2d":
-                mean = de_params[:, :m.num_features]
-                std = de_params[:, m.num_features:2 * m.num_features]
-                m.bias = mean.contiguous().view(-1)
-                m.weight = std.contiguous().view(-1)
-                if de_params.size(1) > 2 * m.num_features:
-                    de_params = de_params[:, 2 * m.num_features:]
+    def assign_de_params(self, de_params):
+        # assign the de_params to the AdaIN layers in the generator
+        for m, (weight, bias) in zip(self.adain_layers,
+                                     self.split_de_params(de_params)):
+            m.weight = weight
+            m.bias = bias
 
-    def get_num_de_params(self, model):
-        # return the number of DE parameters needed by the model
-        num_de_params = 0
-        for m in model.modules():
-            if m.__class__.__name__ == "AdaptiveInstanceNorm2d":
-                num_de_params += 2 * m.num_features
-        return num_de_params
+    def get_num_de_params(self):
+        # return the number of DE parameters needed by the generator
+        return sum(self.de_split)
@@ -110,8 +110,19 @@ class Generator(nn.Module):
         self.print_debug(features, self.fake)
         self.print_debug(features, self.attn)
 
-    def forward(self, x):
-        features = self.main(x)
+    def forward(self, x, de_params=None):
+        # de_params: (weight, bias) for each AdaIN layer in modules() order.
+        # If not given, the ones assigned to the layers are used.
+        if de_params is None:
+            features = self.main(x)
+        else:
+            features = x
+            for layer in self.main:
+                if isinstance(layer, ResidualBlock) and layer.AdaIn:
+                    features = layer(features, de_params[:2])
+                    de_params = de_params[2:]
+                else:
+                    features = layer(features)
         fake_img = self.fake(features)
         mask_img = self.attn(features)
         fake_img = mask_img * x + (1 - mask_img) * fake_img
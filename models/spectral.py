@@ -1,6 +1,7 @@
 import torch
 from torch import nn
 from torch.nn import Parameter
+from misc.utils import autocast
 
 
 def l2normalize(v, eps=1e-12):
@@ -22,12 +23,15 @@ class SpectralNorm(nn.Module):
         w = getattr(self.module, self.name + "_bar")
 
         height = w.data.shape[0]
-        for _ in range(self.power_iterations):
-            v.data = l2normalize(
-                torch.mv(torch.t(w.view(height, -1).data), u.data))
-            u.data = l2normalize(torch.mv(w.view(height, -1).data, v.data))
+        # Power iteration in fp32, u and v must not be cast under --amp
+        with autocast(enabled=False):
+            for _ in range(self.power_iterations):
+                v.data = l2normalize(
+                    torch.mv(torch.t(w.view(height, -1).data), u.data))
+                u.data = l2normalize(
+                    torch.mv(w.view(height, -1).data, v.data))
 
-        sigma = u.dot(w.view(height, -1).mv(v))
+            sigma = u.dot(w.view(height, -1).mv(v))
         setattr(self.module, self.name, w / sigma.expand_as(w))
 
     def _made_params(self):
@@ -60,3 +64,26 @@ class SpectralNorm(nn.Module):
     def forward(self, *args):
         self._update_u_v()
         return self.module.forward(*args)
+
+
+class fixed_spectral_norm(object):
+    # Runs the power iterations of `steps` forwards once, then keeps u and v
+    # fixed inside the block, so that every forward (e.g. the micro-batches
+    # of --accum_steps) sees the same normalized weights.
+    def __init__(self, module, steps=1):
+        self.layers = [
+            m for m in module.modules() if isinstance(m, SpectralNorm)
+        ]
+        self.steps = steps
+
+    def __enter__(self):
+        self.iterations = [m.power_iterations for m in self.layers]
+        for layer, iterations in zip(self.layers, self.iterations):
+            layer.power_iterations = iterations * self.steps
+            layer._update_u_v()
+            layer.power_iterations = 0
+        return self
+
+    def __exit__(self, *args):
+        for layer, iterations in zip(self.layers, self.iterations):
+            layer.power_iterations = iterations
@@ -47,9 +47,15 @@ class Solver(object):
             self.g_optimizer = self.set_optimizer(
                 self.G, self.config.g_lr, self.config.beta1, self.config.beta2)
 
-        # Start with trained model
-        if self.config.pretrained_model and self.verbose:
+        # Start with trained model, on every rank (sharded scores)
+        if self.config.pretrained_model:
             self.load_pretrained_model()
+            if self.config.mode == 'train' and hvd.size() > 1:
+                # Resume every rank with the weights and moments of rank 0
+                for model, optimizer in [(self.D, self.d_optimizer),
+                                         (self.G, self.g_optimizer)]:
+                    hvd.broadcast_parameters(model.state_dict(), root_rank=0)
+                    hvd.broadcast_optimizer_state(optimizer, root_rank=0)
 
         if self.config.mode == 'train' and self.verbose:
             self.print_network(self.D, 'Discriminator')
@@ -63,8 +69,13 @@ class Solver(object):
         optimizer = torch.optim.Adam(model.parameters(), lr, [beta1, beta2])
 
         if hvd.size() > 1:
+            # One allreduce per step with --accum_steps
+            kwargs = {}
+            if self.config.accum_steps > 1:
+                kwargs['backward_passes_per_step'] = self.config.accum_steps
             optimizer = hvd.DistributedOptimizer(
-                optimizer, named_parameters=model.named_parameters())
+                optimizer, named_parameters=model.named_parameters(),
+                **kwargs)
             # Horovod: broadcast parameters & optimizer state.
             hvd.broadcast_parameters(model.state_dict(), root_rank=0)
             hvd.broadcast_optimizer_state(optimizer, root_rank=0)
@@ -126,24 +137,41 @@ class Solver(object):
 
     # ==================================================================#
     # ==================================================================#
-    def save(self, Epoch, iter):
+    def save(self, Epoch, iter, state=None, remove=()):
+        # G, D, optimizers and training state written in the background, G
+        # last. remove: checkpoints (output_model names) deleted afterwards
+        from misc.checkpoint import CheckpointWriter
+        if getattr(self, 'checkpoint', None) is None:
+            self.checkpoint = CheckpointWriter()
         name = self.output_model(Epoch, iter)
-        torch.save(self.G.state_dict(), name.format('G'))
-        torch.save(self.D.state_dict(), name.format('D'))
-
-        def remove(name_1, mode):
-            if os.path.isfile(name_1.format(mode)):
-                os.remove(name_1.format(mode))
+        files = [(name.format('D'), self.D.state_dict())]
+        if self.config.mode == 'train':
+            files += [(name.format('D_optim'), self.d_optimizer.state_dict()),
+                      (name.format('G_optim'), self.g_optimizer.state_dict())]
+        if state is not None:
+            files += [(name.format('State'), state)]
+        files += [(name.format('G'), self.G.state_dict())]
 
+        remove = [name_1 for name_1 in remove if name_1 != name]
         if self.config.model_epoch != 1 and int(
                 Epoch) % self.config.model_epoch == 0:
             for _epoch in range(
                     int(Epoch) - self.config.model_epoch + 1, int(Epoch)):
-                name_1 = os.path.join(
-                    self.config.model_save_path, '{}_{}_{}.pth'.format(
-                        str(_epoch).zfill(4), iter, '{}'))
-                for mode in ['G', 'D']:
-                    remove(name_1, mode)
+                remove.append(
+                    os.path.join(
+                        self.config.model_save_path, '{}_{}_{}.pth'.format(
+                            str(_epoch).zfill(4), iter, '{}')))
+        modes = ['G', 'D', 'G_optim', 'D_optim', 'State']
+        self.checkpoint.save(
+            files, [name_1.format(mode) for name_1 in remove
+                    for mode in modes])
+
+    # ==================================================================#
+    # ==================================================================#
+    def flush_checkpoints(self):
+        # Waits for the checkpoints written in the background
+        if getattr(self, 'checkpoint', None) is not None:
+            self.checkpoint.flush()
 
     # ==================================================================#
     # ==================================================================#
@@ -174,7 +202,14 @@ class Solver(object):
             load(self.G, 'G', replace=True)
         load(self.D, 'D')
 
-        print("Success!!")
+        # Adam moments, if they were saved
+        if self.config.mode == 'train' and os.path.isfile(
+                self.name.format('G_optim')):
+            load(self.g_optimizer, 'G_optim')
+            load(self.d_optimizer, 'D_optim')
+
+        if self.verbose:
+            print("Success!!")
 
     # ==================================================================#
     # ==================================================================#
@@ -253,6 +288,18 @@ class Solver(object):
         else:
             return self.G.random_style(data, seed=seed)
 
+    # ==================================================================#
+    # ==================================================================#
+    def augment(self, real_x, seed=None, data_loader=None):
+        # uint8 batches from get_loader(gpu_augment=True) are cropped,
+        # flipped and normalized on the device
+        if data_loader is None:
+            data_loader = self.data_loader
+        augment = getattr(data_loader, 'augment', None)
+        if augment is None:
+            return real_x
+        return augment(to_var(real_x, volatile=True), seed=seed)
+
     # ==================================================================#
     # ==================================================================#
     def _CLS(self, data):
@@ -432,6 +479,35 @@ class Solver(object):
 
         return domain_embedding
 
+    # ==================================================================#
+    # ==================================================================#
+    def translate_batch(self, real_x, target_list, style, Multimodal):
+        # All the target domains as one batch, --inference_batch images per
+        # generator forward. Returns the images and attention masks per
+        # target, copied to cpu once at the end.
+        n = real_x.size(0)
+        embeddings = torch.cat([
+            self.Modality(target, style, Multimodal, idx=k)
+            for k, target in enumerate(target_list)
+        ], dim=0)
+        targets = torch.cat(target_list, dim=0)
+        index = to_var(torch.arange(targets.size(0)).long() % n,
+                       volatile=True)
+        chunk = self.config.inference_batch
+        fake_x = [[], []]
+        for i in range(0, targets.size(0), chunk):
+            fake = self.G(
+                real_x[index[i:i + chunk]],
+                targets[i:i + chunk],
+                None,
+                DE=embeddings[i:i + chunk])
+            fake_x[0].append(fake[0])
+            fake_x[1].append(fake[1])
+        return [
+            torch.split(to_data(torch.cat(fake, dim=0), cpu=True), n)
+            for fake in fake_x
+        ]
+
     # ==================================================================#
     # ==================================================================#
 
@@ -483,21 +559,36 @@ class Solver(object):
                 else:
                     style = to_var(fixed_style[:real_x.size(0)], volatile=True)
 
-                for k, target in enumerate(target_list):
+                if self.config.inference_batch:
                     start_time = time.time()
-                    embeddings = self.Modality(
-                        target, style, Multimodal, idx=k)
-                    fake_x = self.G(real_x, target, style, DE=embeddings)
+                    fake_x = self.translate_batch(real_x, target_list, style,
+                                                  Multimodal)
                     elapsed = time.time() - start_time
                     elapsed = str(datetime.timedelta(seconds=elapsed))
                     if TIME and flag_time:
-                        print("[{}] Time/batch x forward (bs:{}): {}".format(
-                            modal, real_x.size(0), elapsed))
+                        print("[{}] Time/batch x {} domains (bs:{}): {}".
+                              format(modal, len(target_list), real_x.size(0),
+                                     elapsed))
                         flag_time = False
-
-                    fake_image_list.append(to_data(fake_x[0], cpu=True))
-                    fake_attn_list.append(
-                        to_data(fake_x[1].repeat(1, 3, 1, 1), cpu=True))
+                    fake_image_list.extend(fake_x[0])
+                    fake_attn_list.extend(
+                        [attn.repeat(1, 3, 1, 1) for attn in fake_x[1]])
+                else:
+                    for k, target in enumerate(target_list):
+                        start_time = time.time()
+                        embeddings = self.Modality(
+                            target, style, Multimodal, idx=k)
+                        fake_x = self.G(real_x, target, style, DE=embeddings)
+                        elapsed = time.time() - start_time
+                        elapsed = str(datetime.timedelta(seconds=elapsed))
+                        if TIME and flag_time:
+                            print("[{}] Time/batch x forward (bs:{}): {}".
+                                  format(modal, real_x.size(0), elapsed))
+                            flag_time = False
+
+                        fake_image_list.append(to_data(fake_x[0], cpu=True))
+                        fake_attn_list.append(
+                            to_data(fake_x[1].repeat(1, 3, 1, 1), cpu=True))
 
                 # Create Folder
                 if training:
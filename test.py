@@ -233,6 +233,7 @@ class Test(Solver):
 
         string = '{}'.format(TimeNow_str())
         for i, (real_x, org_c, _) in enumerate(data_loader):
+            real_x = self.augment(real_x, seed=i, data_loader=data_loader)
             save_path = os.path.join(
                 save_folder, '{}_{}_{}.jpg'.format(dataset, '{}', i + 1))
             name = os.path.abspath(save_path.format(string))
@@ -3,13 +3,17 @@ from solver import Solver
 import torch
 import os
 import time
+import inspect
 import warnings
 import datetime
 import numpy as np
 from tqdm import tqdm
 from misc.utils import color, get_fake, get_labels, get_loss_value
-from misc.utils import split, TimeNow, to_var
-from misc.losses import _compute_loss_smooth, _GAN_LOSS
+from misc.utils import autocast, get_torch_version, grad_scaler, split
+from misc.utils import TimeNow, to_var
+from misc.losses import _compute_loss_smooth, _GAN_LOSS, _RaGAN_LOSS
+from misc.checkpoint import set_rng_state
+from models.spectral import fixed_spectral_norm
 import torch.utils.data.distributed
 from misc.utils import horovod
 hvd = horovod()
@@ -22,6 +26,14 @@ class Train(Solver):
         super(Train, self).__init__(config, data_loader)
         self.count_seed = 0
         self.step_seed = 4  # 1 disc - 3 gen
+        # Loss scaling for --amp, None for fp32 training
+        self.d_scaler = grad_scaler(config.amp)
+        self.g_scaler = grad_scaler(config.amp)
+        self.g_params = [p for p in self.G.parameters() if p.requires_grad]
+        self.d_params = [p for p in self.D.parameters() if p.requires_grad]
+        # Tensor.backward(inputs=...) exists since Pytorch 1.8
+        self.backward_inputs = 'inputs' in inspect.signature(
+            torch.Tensor.backward).parameters
         self.run()
 
     # ============================================================#
@@ -38,6 +50,55 @@ class Train(Solver):
         self.g_optimizer.zero_grad()
         self.d_optimizer.zero_grad()
 
+    # ============================================================#
+    # ============================================================#
+    def backward(self, loss, inputs=None):
+        # Gradients only for inputs if given and supported, otherwise the
+        # other parameters are frozen by the caller (Gen_update)
+        if inputs is None or not self.backward_inputs:
+            loss.backward()
+        else:
+            loss.backward(inputs=inputs)
+
+    # ============================================================#
+    # ============================================================#
+    def set_requires_grad(self, params, requires_grad):
+        for p in params:
+            try:
+                p.requires_grad_(requires_grad)
+            except AttributeError:
+                p.requires_grad = requires_grad
+
+    # ============================================================#
+    # ============================================================#
+    def optimizer_step(self, loss, optimizer, scaler=None, inputs=None):
+        self.reset_grad()
+        self.scaled_backward(loss, scaler, inputs)
+        self.apply_step(optimizer, scaler)
+
+    # ============================================================#
+    # ============================================================#
+    def scaled_backward(self, loss, scaler=None, inputs=None):
+        if scaler is None:
+            self.backward(loss, inputs)
+        else:
+            self.backward(scaler.scale(loss), inputs)
+
+    # ============================================================#
+    # ============================================================#
+    def apply_step(self, optimizer, scaler=None):
+        if scaler is None:
+            optimizer.step()
+            return
+        if hvd.size() > 1:
+            # Allreduce the scaled gradients before the scaler checks them
+            optimizer.synchronize()
+            with optimizer.skip_synchronize():
+                scaler.step(optimizer)
+        else:
+            scaler.step(optimizer)
+        scaler.update()
+
     # ============================================================#
     # ============================================================#
     def update_loss(self, loss, value):
@@ -65,7 +126,7 @@ class Train(Solver):
             fixed_label.append(labels)
             if i == max(1, int(16 / self.config.batch_size)):
                 break
-        fixed_x = torch.cat(fixed_x, dim=0)
+        fixed_x = self.augment(torch.cat(fixed_x, dim=0), seed=0)
         fixed_label = torch.cat(fixed_label, dim=0)
         fixed_style = self.random_style(fixed_x, seed=self.count_seed)
 
@@ -88,7 +149,7 @@ class Train(Solver):
 
     # ============================================================#
     # ============================================================#
-    def _GAN_LOSS(self, real_x, fake_x, label):
+    def cls_target(self, label):
         cross_entropy = self.config.dataset_fake in [
             'painters_14', 'Animals', 'Image2Weather', 'Image2Season',
             'Image2Edges', 'RafD', 'BP4D_idt'
@@ -96,6 +157,12 @@ class Train(Solver):
         ]
         if cross_entropy:
             label = torch.max(label, dim=1)[1]
+        return label, cross_entropy
+
+    # ============================================================#
+    # ============================================================#
+    def _GAN_LOSS(self, real_x, fake_x, label):
+        label, cross_entropy = self.cls_target(label)
         return _GAN_LOSS(
             self.D, real_x, fake_x, label, cross_entropy=cross_entropy)
 
@@ -128,13 +195,75 @@ class Train(Solver):
             self.PRINT('Decay learning rate to g_lr: {}, d_lr: {}.'.format(
                 self.g_lr, self.d_lr))
 
+    # ============================================================#
+    # ============================================================#
+    def train_state(self, epoch, iter):
+        # Everything needed to continue exactly with batch iter of epoch,
+        # the weights and optimizers are saved next to it
+        from misc.checkpoint import rng_state
+        state = {
+            'epoch': epoch,
+            'iter': iter,
+            'total_iter': self.total_iter,
+            'count_seed': self.count_seed,
+            'g_lr': self.g_lr,
+            'd_lr': self.d_lr,
+            'LOSS': {key: [float(v) for v in value]
+                     for key, value in self.LOSS.items()} if iter else {},
+            'sampler': self.data_loader.sampler.state_dict(
+                start=iter * self.data_loader.batch_size),
+            'rng': rng_state(),
+            # Seeds of the loader workers of a partial epoch
+            'loader_rng': self.loader_rng if iter else None
+        }
+        for name in ['d_scaler', 'g_scaler']:
+            if getattr(self, name) is not None:
+                state[name] = getattr(self, name).state_dict()
+        return state
+
+    # ============================================================#
+    # ============================================================#
+    def load_train_state(self, state):
+        self.g_lr = state['g_lr']
+        self.d_lr = state['d_lr']
+        self.update_lr(self.g_lr, self.d_lr)
+        self.count_seed = state['count_seed']
+        self.LOSS = state['LOSS']
+        self.start_iter = state['iter']
+        self.sampler_state = state['sampler']
+        self.resume_rng = (state['rng'], state['loader_rng'])
+        for name in ['d_scaler', 'g_scaler']:
+            if name in state and getattr(self, name) is not None:
+                getattr(self, name).load_state_dict(state[name])
+        return state['epoch'], state['total_iter']
+
     # ============================================================#
     # ============================================================#
     def RESUME_INFO(self):
+        self.start_iter = 0
+        self.sampler_state = None
+        self.resume_rng = None
+        self.LOSS = {}
         if not self.config.pretrained_model:
             return 0, 0
-        start = int(self.config.pretrained_model.split('_')[0]) + 1
-        total_iter = start * int(self.config.pretrained_model.split('_')[1])
+        state_name = os.path.join(
+            self.config.model_save_path,
+            '{}_State.pth'.format(self.config.pretrained_model))
+        state = None
+        if self.verbose and os.path.isfile(state_name):
+            state = torch.load(state_name)
+        # Iteration, seeds and RNG of rank 0 on every rank
+        state = comm.bcast(state, root=0)
+        if state is not None:
+            return self.load_train_state(state)
+        # Checkpoint without training state: its name cannot tell whether
+        # the epoch was complete (batch size or GPUs may have changed), so
+        # training starts with the next epoch
+        epoch, last_iter = [
+            int(i) for i in self.config.pretrained_model.split('_')[:2]
+        ]
+        start = epoch + 1
+        total_iter = start * last_iter
         self.count_seed = start * total_iter * self.step_seed
         for e in range(start):
             if e > self.config.num_epochs_decay:
@@ -144,10 +273,11 @@ class Train(Solver):
     # ============================================================#
     # ============================================================#
     def MISC(self, epoch, iter):
-        if epoch % self.config.save_epoch == 0 and self.verbose:
-            # Save Weights
-            self.save(epoch, iter + 1)
+        # Decay learning rate
+        if epoch > self.config.num_epochs_decay:
+            self.Decay_lr(epoch)
 
+        if epoch % self.config.save_epoch == 0 and self.verbose:
             # Save Translation
             self.generate_SMIT(
                 self.fixed_x,
@@ -181,16 +311,38 @@ class Train(Solver):
             self.PRINT(log)
             # self.PLOT(epoch)
 
+            # Save Weights, with the state to start the next epoch
+            self.save(
+                epoch,
+                iter + 1,
+                self.train_state(epoch + 1, 0),
+                remove=[self.mid_checkpoint] if self.mid_checkpoint else [])
+            self.mid_checkpoint = None
+
         comm.Barrier()
-        # Decay learning rate
-        if epoch > self.config.num_epochs_decay:
-            self.Decay_lr(epoch)
 
     # ============================================================#
     # ============================================================#
     def reset_losses(self):
         return {}
 
+    # ============================================================#
+    # ============================================================#
+    def save_state(self, epoch, iter):
+        # Mid-epoch checkpoint every --state_step iterations, only the last
+        # one is kept
+        if not self.config.state_step or not self.verbose:
+            return
+        if (iter + 1) % self.config.state_step or \
+                iter + 1 == len(self.data_loader):
+            return
+        self.save(
+            epoch,
+            iter + 1,
+            self.train_state(epoch, iter + 1),
+            remove=[self.mid_checkpoint] if self.mid_checkpoint else [])
+        self.mid_checkpoint = self.output_model(epoch, iter + 1)
+
     # ============================================================#
     # ============================================================#
     def current_losses(self, mode, **kwargs):
@@ -211,80 +363,271 @@ class Train(Solver):
 
     # ============================================================#
     # ============================================================#
-    def train_model(self, generator=False, discriminator=False):
-        if torch.cuda.device_count() > 1 and hvd.size() == 1:
-            G = self.G.module
-        else:
-            G = self.G
-        for p in G.generator.parameters():
-            try:
-                p.requires_grad_(generator)
-            except AttributeError:
-                p.requires_grad = generator
-        for p in self.D.parameters():
-            try:
-                p.requires_grad_(discriminator)
-            except AttributeError:
-                p.requires_grad = discriminator
+    def micro_batches(self, *args):
+        # The tensors split along the batch in (at most) --accum_steps chunks
+        chunks = [torch.chunk(arg, self.config.accum_steps) for arg in args]
+        return list(zip(*chunks))
+
+    # ============================================================#
+    # ============================================================#
+    def generate(self, real_x, fake_c, style):
+        # G outputs of the whole batch by micro-batches, without graph
+        no_grad = open('/var/tmp/null.txt',
+                       'w') if get_torch_version() < 1.0 else torch.no_grad()
+        outs = []
+        with no_grad, autocast(self.config.amp):
+            for batch in self.micro_batches(real_x, fake_c, style):
+                outs.append(self.G(*batch))
+        return [torch.cat(out) for out in zip(*outs)]
+
+    # ============================================================#
+    # ============================================================#
+    def D_outputs(self, x, requires_grad=False):
+        # D outputs of the whole batch by micro-batches, without graph, as
+        # fp32 leaves: [src per scale], [cls per scale]
+        no_grad = open('/var/tmp/null.txt',
+                       'w') if get_torch_version() < 1.0 else torch.no_grad()
+        outs = []
+        with no_grad, autocast(self.config.amp):
+            for (batch, ) in self.micro_batches(x):
+                outs.append(self.D(batch))
+        src, cls = [[
+            torch.cat(scale).float().requires_grad_(requires_grad)
+            for scale in zip(*out)
+        ] for out in zip(*outs)]
+        return src, cls
 
     # ============================================================#
     # ============================================================#
+    def accumulate(self, loss, outputs, forward, batch, optimizer,
+                   scaler=None, inputs=None):
+        # --accum_steps: loss is the loss of the whole batch on D outputs
+        # from D_outputs. Each micro-batch recomputes them with graph,
+        # forward(*micro_batch) -> (outputs, other losses), and backpropagates
+        # sum(d loss / d outputs * outputs) + other losses. The gradients add
+        # up to the ones of the whole batch, the batch means of the
+        # relativistic loss included.
+        grads = torch.autograd.grad(loss, outputs)
+        grads = [torch.chunk(grad, self.config.accum_steps) for grad in grads]
+        self.reset_grad()
+        for index, micro_batch in enumerate(self.micro_batches(*batch)):
+            with autocast(self.config.amp):
+                outs, surrogate = forward(*micro_batch)
+            for out, grad in zip(outs, grads):
+                surrogate = surrogate + (out.float() * grad[index]).sum()
+            self.scaled_backward(surrogate, scaler, inputs)
+        self.apply_step(optimizer, scaler)
 
-    def Dis_update(self, real_x, real_c, fake_c):
-        self.train_model(discriminator=True)
+    # ============================================================#
+    # ============================================================#
+    def Dis_update(self, real_x, real_c, fake_c, fake_x=None):
+        # fake_x: G(real_x, fake_c) already computed (Fused_update)
         real_x, real_c, fake_c = self.to_var(real_x, real_c, fake_c)
         style_fake = to_var(self.random_style(real_x, seed=self.count_seed))
         self.count_seed += 1
-        fake_x = self.G(real_x, fake_c, style_fake)[0]
-        d_loss_src, d_loss_cls = self._GAN_LOSS(real_x, fake_x, real_c)
+        if self.config.accum_steps > 1:
+            if fake_x is None:
+                fake_x = self.generate(real_x, fake_c, style_fake)[0]
+            self.Dis_accum_update(real_x, real_c, fake_x.detach())
+            return
+
+        # No graph through G for the D step
+        no_grad = open('/var/tmp/null.txt',
+                       'w') if get_torch_version() < 1.0 else torch.no_grad()
+        with autocast(self.config.amp):
+            if fake_x is None:
+                with no_grad:
+                    fake_x = self.G(real_x, fake_c, style_fake)[0]
+            d_loss_src, d_loss_cls = self._GAN_LOSS(real_x, fake_x.detach(),
+                                                    real_c)
 
         self.loss['Dsrc'] = d_loss_src
         self.loss['Dcls'] = d_loss_cls * self.config.lambda_cls
         d_loss = self.current_losses('D', **self.loss)
-        self.reset_grad()
-        d_loss.backward()
-        self.d_optimizer.step()
+        self.optimizer_step(d_loss, self.d_optimizer, self.d_scaler)
 
     # ============================================================#
     # ============================================================#
-    def Gen_update(self, real_x, real_c, fake_c):
-        self.train_model(generator=True)
-        real_x, real_c, fake_c = self.to_var(real_x, real_c, fake_c)
-        criterion_l1 = torch.nn.L1Loss()
-        style_fake = to_var(self.random_style(real_x, seed=self.count_seed))
-        style_rec = to_var(self.random_style(real_x, seed=self.count_seed + 1))
-        style_identity = to_var(
-            self.random_style(real_x, seed=self.count_seed + 2))
-        self.count_seed += 3
+    def Dis_accum_update(self, real_x, real_c, fake_x):
+        label, cross_entropy = self.cls_target(real_c)
 
-        fake_x = self.G(real_x, fake_c, style_fake)
+        def forward(real_x, fake_x):
+            src_real, cls_real = self.D(real_x)
+            src_fake, _ = self.D(fake_x)
+            return src_real + cls_real + src_fake, 0
 
-        g_loss_src, g_loss_cls = self._GAN_LOSS(fake_x[0], real_x, fake_c)
-        self.loss['Gsrc'] = g_loss_src
-        self.loss['Gcls'] = g_loss_cls * self.config.lambda_cls
+        # Same normalized weights for both passes
+        with fixed_spectral_norm(self.D, steps=2):
+            src_real, cls_real = self.D_outputs(real_x, requires_grad=True)
+            src_fake, _ = self.D_outputs(fake_x, requires_grad=True)
+            d_loss_src, d_loss_cls = _RaGAN_LOSS(
+                src_real, cls_real, src_fake, label,
+                cross_entropy=cross_entropy)
+            self.loss['Dsrc'] = d_loss_src
+            self.loss['Dcls'] = d_loss_cls * self.config.lambda_cls
+            d_loss = self.current_losses('D', **self.loss)
+            self.accumulate(d_loss, src_real + cls_real + src_fake, forward,
+                            [real_x, fake_x], self.d_optimizer,
+                            self.d_scaler)
+
+    # ============================================================#
+    # ============================================================#
+    def Gen_losses(self, real_x, real_c, fake_x, style_rec, style_identity,
+                   weight=1.0):
+        # Losses of G besides the GAN ones. With --accum_steps, weight
+        # (micro-batch size / batch size) turns the means over a micro-batch
+        # into its share of the batch means, the smoothness terms are sums.
+        criterion_l1 = torch.nn.L1Loss()
+        loss = {}
 
         # REC LOSS
         rec_x = self.G(fake_x[0], real_c, style_rec)
         g_loss_rec = criterion_l1(rec_x[0], real_x)
-        self.loss['Grec'] = self.config.lambda_rec * g_loss_rec
+        loss['Grec'] = self.config.lambda_rec * g_loss_rec * weight
 
         # ========== Attention Part ==========#
-        self.loss['Gatm'] = self.config.lambda_mask * (
-            torch.mean(rec_x[1]) + torch.mean(fake_x[1]))
-        self.loss['Gats'] = self.config.lambda_mask_smooth * (
+        loss['Gatm'] = self.config.lambda_mask * (
+            torch.mean(rec_x[1]) + torch.mean(fake_x[1])) * weight
+        loss['Gats'] = self.config.lambda_mask_smooth * (
             _compute_loss_smooth(rec_x[1]) + _compute_loss_smooth(fake_x[1]))
 
         # ========== Identity Part ==========#
         if self.config.Identity:
             idt_x = self.G(real_x, real_c, style_identity)[0]
             g_loss_idt = criterion_l1(idt_x, real_x)
-            self.loss['Gidt'] = self.config.lambda_idt * \
-                g_loss_idt
+            loss['Gidt'] = self.config.lambda_idt * g_loss_idt * weight
+        return loss
+
+    # ============================================================#
+    # ============================================================#
+    def Gen_update(self, real_x, real_c, fake_c, fake_x=None,
+                   style_fake=None):
+        # fake_x: G(real_x, fake_c, style_fake) already computed
+        # (Fused_update)
+        real_x, real_c, fake_c = self.to_var(real_x, real_c, fake_c)
+        if style_fake is None:
+            style_fake = to_var(
+                self.random_style(real_x, seed=self.count_seed))
+        style_rec = to_var(self.random_style(real_x, seed=self.count_seed + 1))
+        style_identity = to_var(
+            self.random_style(real_x, seed=self.count_seed + 2))
+        self.count_seed += 3
+        styles = [style_fake, style_rec, style_identity]
+        # Without backward(inputs=) (Pytorch < 1.8), D is frozen instead:
+        # its weights must not get gradients, nor Horovod allreduces, here
+        if not self.backward_inputs:
+            self.set_requires_grad(self.d_params, False)
+        if self.config.accum_steps > 1:
+            self.Gen_accum_update(real_x, real_c, fake_c, styles, fake_x)
+        else:
+            self.Gen_batch_update(real_x, real_c, fake_c, styles, fake_x)
+        if not self.backward_inputs:
+            self.set_requires_grad(self.d_params, True)
+
+    # ============================================================#
+    # ============================================================#
+    def Gen_batch_update(self, real_x, real_c, fake_c, styles, fake_x=None):
+        style_fake, style_rec, style_identity = styles
+        with autocast(self.config.amp):
+            if fake_x is None:
+                fake_x = self.G(real_x, fake_c, style_fake)
+
+            g_loss_src, g_loss_cls = self._GAN_LOSS(fake_x[0], real_x, fake_c)
+            self.loss['Gsrc'] = g_loss_src
+            self.loss['Gcls'] = g_loss_cls * self.config.lambda_cls
+            self.loss.update(
+                self.Gen_losses(real_x, real_c, fake_x, style_rec,
+                                style_identity))
 
         g_loss = self.current_losses('G', **self.loss)
-        self.reset_grad()
-        g_loss.backward()
-        self.g_optimizer.step()
+        # The gradients of D are not needed for the G step
+        self.optimizer_step(
+            g_loss, self.g_optimizer, self.g_scaler, inputs=self.g_params)
+
+    # ============================================================#
+    # ============================================================#
+    def Gen_accum_update(self, real_x, real_c, fake_c, styles, fake_x=None):
+        # fake_x (without graph) only gives the GAN loss of the whole batch,
+        # G runs again with graph on every micro-batch
+        style_fake, style_rec, style_identity = styles
+        if fake_x is None:
+            fake_x = self.generate(real_x, fake_c, style_fake)
+        label, cross_entropy = self.cls_target(fake_c)
+        batch_size = real_x.size(0)
+        losses = {}
+
+        def forward(real_x, real_c, fake_c, style_fake, style_rec,
+                    style_identity):
+            fake_x = self.G(real_x, fake_c, style_fake)
+            src_fake, cls_fake = self.D(fake_x[0])
+            loss = self.Gen_losses(
+                real_x, real_c, fake_x, style_rec, style_identity,
+                weight=float(real_x.size(0)) / batch_size)
+            for key, value in loss.items():
+                losses[key] = losses.get(key, 0) + value.detach()
+            return src_fake + cls_fake, sum(loss.values())
+
+        # Same normalized weights for both passes
+        with fixed_spectral_norm(self.D, steps=2):
+            src_fake, cls_fake = self.D_outputs(
+                fake_x[0].detach(), requires_grad=True)
+            src_real, _ = self.D_outputs(real_x)
+            g_loss_src, g_loss_cls = _RaGAN_LOSS(
+                src_fake, cls_fake, src_real, label,
+                cross_entropy=cross_entropy)
+            g_loss_cls = g_loss_cls * self.config.lambda_cls
+            self.accumulate(g_loss_src + g_loss_cls, src_fake + cls_fake,
+                            forward, [
+                                real_x, real_c, fake_c, style_fake,
+                                style_rec, style_identity
+                            ], self.g_optimizer, self.g_scaler,
+                            inputs=self.g_params)
+
+        self.loss['Gsrc'] = g_loss_src
+        self.loss['Gcls'] = g_loss_cls
+        self.loss.update(losses)
+        self.current_losses('G', **self.loss)
+
+    # ============================================================#
+    # ============================================================#
+    def Fused_update(self, real_x, real_c, fake_c):
+        # One generator pass over the whole batch for both steps: D is
+        # trained on it detached, then G backpropagates through it. The
+        # styles follow the same seeds as Dis_update + Gen_update.
+        real_x, real_c, fake_c = self.to_var(real_x, real_c, fake_c)
+        style_fake = to_var(self.random_style(real_x, seed=self.count_seed))
+        if self.config.accum_steps > 1:
+            # Without graph, Gen_update runs G again by micro-batches
+            fake_x = self.generate(real_x, fake_c, style_fake)
+        else:
+            with autocast(self.config.amp):
+                fake_x = self.G(real_x, fake_c, style_fake)
+        self.Dis_update(real_x, real_c, fake_c, fake_x=fake_x[0])
+        self.Gen_update(
+            real_x, real_c, fake_c, fake_x=fake_x, style_fake=style_fake)
+
+    # ============================================================#
+    # ============================================================#
+    def train_step(self, real_x, real_c, _iter):
+        fake_c = get_fake(real_c, seed=_iter)
+        if self.config.fused_step:
+            self.Fused_update(real_x, real_c, fake_c)
+            return
+
+        # RaGAN uses different data for Dis and Gen
+        real_x0, real_x1 = split(real_x)
+        real_c0, real_c1 = split(real_c)
+        fake_c0, fake_c1 = split(fake_c)
+
+        # ============================================================#
+        # ======================== Train D ===========================#
+        # ============================================================#
+        self.Dis_update(real_x0, real_c0, fake_c0)
+
+        # ============================================================#
+        # ======================== Train G ===========================#
+        # ============================================================#
+        self.Gen_update(real_x1, real_c1, fake_c1)
 
     # ============================================================#
     # ============================================================#
@@ -298,60 +641,72 @@ class Train(Solver):
 
         # Start with trained info if exists
         start, self.total_iter = self.RESUME_INFO()
+        self.mid_checkpoint = None
 
         # Fixed inputs, target domain labels, and style for debugging
         self.fixed_x, self.fixed_label, self.fixed_style = self.debug_vars(
             start)
+        if self.sampler_state is not None:
+            self.data_loader.sampler.load_state_dict(self.sampler_state)
 
         self.PRINT("Current time: " + TimeNow())
         self.PRINT("Debug Log txt: " + os.path.realpath(self.config.log.name))
 
         # Log info
-        # RaGAN uses different data for Dis and Gen
-        self.Log = self.PRINT_LOG(self.config.batch_size // 2)
+        # RaGAN uses different data for Dis and Gen, unless --fused_step
+        self.Log = self.PRINT_LOG(
+            self.config.batch_size if self.config.fused_step else
+            self.config.batch_size // 2)
 
         self.start_time = time.time()
 
         # Start training
         for epoch in range(start, self.config.num_epochs):
+            # Shuffling dataset each epoch
+            self.data_loader.sampler.set_epoch(epoch)
             self.D.train()
             self.G.train()
-            self.LOSS = {}
+            if self.start_iter == 0:
+                self.LOSS = {}
+            resume_rng, self.resume_rng = self.resume_rng, None
+            if resume_rng is not None:
+                # A partial epoch needs the loader seeds of its start
+                set_rng_state(resume_rng[0])
+                if resume_rng[1] is not None:
+                    torch.set_rng_state(resume_rng[1])
+            # Seeds of the loader workers for this epoch
+            self.loader_rng = torch.get_rng_state()
             desc_bar = '[Iter: %d] Epoch: %d/%d' % (self.total_iter, epoch,
                                                     self.config.num_epochs)
             epoch_verbose = (epoch % self.config.save_epoch) and epoch != 0
             self.progress_bar = tqdm(
-                enumerate(self.data_loader),
+                enumerate(self.data_loader, self.start_iter),
                 unit_scale=True,
+                initial=self.start_iter,
                 total=len(self.data_loader),
                 desc=desc_bar,
                 disable=not self.verbose or epoch_verbose,
                 ncols=5)
+            if resume_rng is not None and resume_rng[1] is not None:
+                # Generators as they were at the checkpoint
+                torch.set_rng_state(resume_rng[0]['torch'])
             for _iter, (real_x, real_c, _) in self.progress_bar:
                 self.loss = self.reset_losses()
                 self.total_iter += 1 * hvd.size()
-                # RaGAN uses different data for Dis and Gen
-                real_x0, real_x1 = split(real_x)
-                real_c0, real_c1 = split(real_c)
-                fake_c = get_fake(real_c, seed=_iter)
-                fake_c0, fake_c1 = split(fake_c)
-
-                # ============================================================#
-                # ======================== Train D ===========================#
-                # ============================================================#
-                self.Dis_update(real_x0, real_c0, fake_c0)
-
-                # ============================================================#
-                # ======================== Train G ===========================#
-                # ============================================================#
-                self.Gen_update(real_x1, real_c1, fake_c1)
+                # Different crops and flips on every rank
+                real_x = self.augment(
+                    real_x, seed=self.count_seed * hvd.size() + hvd.rank())
+                self.train_step(real_x, real_c, _iter)
 
                 # ====================== DEBUG =====================#
                 self.INFO(epoch, _iter)
+                self.save_state(epoch, _iter)
 
             # ============================================================#
             # ======================= MISCELANEOUS =======================#
             # ============================================================#
-            # Shuffling dataset each epoch
-            self.data_loader.dataset.shuffle(epoch)
+            self.start_iter = 0
             self.MISC(epoch, _iter)
+
+        # Last checkpoints on disk before testing
+        self.flush_checkpoints()